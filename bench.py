@@ -0,0 +1,236 @@
+#!/usr/bin/env python3
+
+import argparse
+import contextlib
+import json
+import logging
+import os
+import platform
+import shutil
+import tempfile
+import time
+import numpy as np
+import type_ratio
+
+COLORS = ['#f26924', '#0088cc', '#7a9a01', '#9b59b6', '#e74c3c', '#34495e']
+
+
+def get_metadata(args):
+    metadata = type_ratio.Metadata()
+    metadata.datasets = ['suffix1', 'suffix2']
+    metadata.dataset_labels = ['Suffix 1', 'Suffix 2']
+    metadata.title = 'Benchmark'
+    metadata.xlabel = 'Suffix 1 and 2 types'
+    metadata.ylabel = 'Proportion of suffix 1 types'
+    metadata.timeseries_xlabel = 'Time period'
+    colls = get_colls(args)
+    metadata.coll_labels = {c: f'Collection {c}' for c in colls}
+    metadata.coll_colors = {
+        c: COLORS[i % len(COLORS)]
+        for i, c in enumerate(colls)
+    }
+    metadata.periods = get_periods(args)
+    metadata.periods_highlight = metadata.periods[:1]
+    metadata.tick_hook = lambda x: True
+    metadata.shading_fraction = [0.1, 0.025]
+    metadata.yrange = [0, 100]
+    metadata.trend_yrange = [0, 100]
+    metadata.trend_step = [len(metadata.periods)]
+    metadata.pdf = args.png is None
+    metadata.png = args.png
+    return metadata
+
+
+def get_periods(args):
+    return [(1500 + 100 * i, 1600 + 100 * i) for i in range(args.periods)]
+
+
+def get_colls(args):
+    return [f'C{i + 1}' for i in range(args.colls)]
+
+
+def get_corpus(args):
+    """Samples with tokens drawn from a Zipf distribution over a vocabulary
+    of args.types types per dataset; each sample belongs to one period and
+    one collection."""
+    rng = np.random.default_rng(args.seed)
+    periods = get_periods(args)
+    colls = get_colls(args)
+    ranks = np.arange(1, args.types + 1, dtype=np.float64)
+    p = ranks**-args.zipf
+    p /= p.sum()
+    ids = [[
+        type_ratio.vocabulary.intern(f'{prefix}{i}') for i in range(args.types)
+    ] for prefix in ['t', 'T']]
+    samplelist = []
+    for i in range(args.samples):
+        s = type_ratio.Sample(f'sample{i + 1}',
+                              [periods[rng.integers(len(periods))]],
+                              [colls[rng.integers(len(colls))]])
+        for dataset in range(2):
+            count = rng.poisson(args.tokens / 2)
+            drawn = rng.choice(args.types, size=count, p=p)
+            types, counts = np.unique(drawn, return_counts=True)
+            for t, c in zip(types, counts):
+                s.feed_id(dataset, ids[dataset][t], int(c))
+        samplelist.append(s)
+    return samplelist
+
+
+def get_engine(name, args):
+    if name == 'numpy':
+        return type_ratio.NumpyEngine()
+    return type_ratio.SubprocessEngine(split=args.split)
+
+
+class Timer:
+    """Records the wall-clock time of each stage in seconds."""
+
+    def __init__(self):
+        self.stages = {}
+
+    @contextlib.contextmanager
+    def __call__(self, stage):
+        logging.info(stage)
+        start = time.perf_counter()
+        yield
+        self.stages[stage] = time.perf_counter() - start
+
+
+def bench(engine_name, args):
+    """Runs the stages of Driver.calc one at a time in an empty working
+    directory, so that no results are reused."""
+    timer = Timer()
+    engine = get_engine(engine_name, args)
+    with timer('corpus'):
+        type_ratio.set_vocabulary(type_ratio.Vocabulary())
+        samplelist = get_corpus(args)
+    with timer('timeseries'):
+        ts = type_ratio.TimeSeries(get_metadata(args), get_colls(args),
+                                   samplelist)
+    driver = type_ratio.Driver('bench', engine=engine)
+    driver.add_timeseries(ts)
+    curves = [c for curve in driver.curves for c in curve.get_curves()]
+    with timer('write_input'):
+        jobs = {}
+        for c in curves:
+            c.calc_write_input()
+            jobs.setdefault(c.digest, c)
+        for c in curves:
+            c.input_data = None
+    with timer('engine'):
+        engine.run(jobs,
+                   args.iter,
+                   tolerance=args.tolerance,
+                   levels=driver.levels())
+    with timer('read_output'):
+        index = type_ratio.ResultIndex()
+        for digest, c in jobs.items():
+            index.add_input(digest, c.input_size)
+            index.add_new_outputs(digest, args.iter, engine.version,
+                                  args.tolerance)
+        index.commit()
+        driver.clean()
+        driver.find_best(index, jobs)
+        index.close()
+        for c in curves:
+            if c is jobs[c.digest]:
+                c.calc_read_output(driver.best)
+            else:
+                c.share_output(jobs[c.digest])
+    with timer('summary'):
+        with open(os.path.join(driver.dir_result, 'summary.txt'), 'w') as f:
+            ts.print_summary(f)
+        driver.write_freq()
+    if args.plots:
+        with timer('plots'):
+            type_ratio.render_figures(ts.figures(driver.dir_result),
+                                      args.workers)
+    with timer('html'):
+        ts.illustrate_freq(driver.dir_result)
+    return {
+        'engine': engine_name,
+        'engine_version': engine.version,
+        'jobs': len(jobs),
+        'curves': len(curves),
+        'tokens': sum(sum(s.counts[0]) + sum(s.counts[1]) for s in samplelist),
+        'stages': timer.stages,
+        'total': sum(timer.stages.values()),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Times each stage of the pipeline on a synthetic corpus '
+        'and writes the results as JSON.')
+    parser.add_argument('--samples', type=int, default=1000)
+    parser.add_argument('--types',
+                        type=int,
+                        default=1000,
+                        help='vocabulary size of each dataset')
+    parser.add_argument('--tokens',
+                        type=float,
+                        default=20,
+                        help='mean number of tokens per sample')
+    parser.add_argument('--zipf',
+                        type=float,
+                        default=1.0,
+                        help='exponent of the Zipf distribution of types')
+    parser.add_argument('--periods', type=int, default=4)
+    parser.add_argument('--colls', type=int, default=2)
+    parser.add_argument('--iter', type=int, default=10000)
+    parser.add_argument('--tolerance', type=float)
+    parser.add_argument('--split', type=int)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--engine',
+                        action='append',
+                        choices=['subprocess', 'numpy'],
+                        help='engine to benchmark; can be repeated')
+    parser.add_argument('--no-plots', dest='plots', action='store_false')
+    parser.add_argument('--png', type=int, help='render PNG at this DPI')
+    parser.add_argument('--workers', type=int)
+    parser.add_argument('--workdir',
+                        help='directory for the data and results '
+                        '(default: a temporary directory)')
+    parser.add_argument('--output',
+                        default='bench.json',
+                        help='JSON output file (default: bench.json)')
+    args = parser.parse_args()
+    logging.basicConfig(
+        format='%(relativeCreated)8d %(levelname)s %(message)s',
+        level=logging.INFO)
+    output = os.path.abspath(args.output)
+    params = {
+        k: v
+        for k, v in vars(args).items()
+        if k not in ['engine', 'workdir', 'output']
+    }
+    result = {
+        'params': params,
+        'system': {
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'machine': platform.machine(),
+            'cpus': os.cpu_count(),
+        },
+        'runs': [],
+    }
+    cwd = os.getcwd()
+    for engine_name in args.engine or ['subprocess']:
+        workdir = args.workdir or tempfile.mkdtemp(prefix='type-ratio-bench-')
+        workdir = os.path.join(workdir, engine_name)
+        os.makedirs(workdir, exist_ok=True)
+        os.chdir(workdir)
+        try:
+            result['runs'].append(bench(engine_name, args))
+        finally:
+            os.chdir(cwd)
+            if args.workdir is None:
+                shutil.rmtree(os.path.dirname(workdir))
+    with open(output, 'w') as f:
+        json.dump(result, f, indent=2)
+        f.write('\n')
+    logging.info(f'wrote {output}')
+
+
+main()
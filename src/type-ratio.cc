@@ -1,11 +1,28 @@
 #include <algorithm>
+#include <atomic>
 #include <cassert>
+#include <cerrno>
+#include <chrono>
+#include <cmath>
+#include <condition_variable>
+#include <cstdint>
+#include <deque>
+#include <exception>
+#include <fcntl.h>
 #include <filesystem>
 #include <fstream>
 #include <iostream>
+#include <limits>
+#include <map>
+#include <mutex>
+#include <numeric>
+#include <omp.h>
 #include <random>
+#include <sstream>
 #include <string>
 #include <system_error>
+#include <thread>
+#include <unistd.h>
 #include <unordered_set>
 #include <vector>
 
@@ -20,35 +37,368 @@ using std::vector;
 using ll = long long;
 using rng_t = std::mt19937_64;
 using flag_t = int;
+using word_t = std::uint64_t;
+constexpr int word_bits = 64;
 
 constexpr ll exact_preference = 10;
+
+// Largest number of samples for which exact results can be calculated by
+// summing over subsets; the weights are calculated with 128-bit integers.
+constexpr int subset_max_n = 30;
+
+// Up to this many samples, subset weights are not scaled, so that the
+// results are identical to enumerating all permutations; (n+1)! still
+// fits in 64 bits.
+constexpr int subset_unscaled_n = 19;
+
+// Binary file formats; all integers are little-endian.
+//
+// Input: magic, version, n, m0, m1, nnz as int32, followed by the CSR
+// representation of the samples: n+1 int32 offsets and nnz int32 types.
+// Types 0..m0-1 are from the first dataset and types m0..m0+m1-1 from the
+// second dataset.
+//
+// Output: magic, version, layout, streams as int32, followed by rows,
+// cols, iter, seed as int64; iter is 0 for exact results, and streams is 0
+// unless the iterations were split into several random streams. The header is
+// followed by the accumulator: with dense layout rows*cols int64 values,
+// with banded layout rows int32 first, rows int32 last, and then for each
+// row last-first int64 values. Random outputs with a non-default seed are
+// named digest.iter.sSEED. Outputs of runs with different seeds can be added
+// together; type_ratio.py writes such merged outputs with version 2, in
+// which the seed field is the number of seeds and the seeds follow the
+// header as int64.
+constexpr char input_magic[4] = {'T', 'R', 'I', 'N'};
+constexpr char output_magic[4] = {'T', 'R', 'O', 'U'};
+constexpr std::int32_t format_version = 1;
+constexpr std::int32_t layout_dense = 0;
+constexpr std::int32_t layout_banded = 1;
+constexpr ll default_seed = 1;
+
+// With automatic accumulator selection, use a dense accumulator if it has at
+// most this many counters.
+constexpr ll dense_limit = 1 << 20;
+
+// With automatic kernel selection, use the bitset kernel if the samples have
+// on average at least this many types per nonzero word of their bitsets, or
+// if clearing the flags of all types would cost more than the types of all
+// samples.
+constexpr ll bitset_density = 2;
+
+// Adaptive mode: the size of the first round, and the number of permutations
+// that must fall in the tail at each level before it can be considered
+// converged.
+constexpr ll adaptive_first_round = 1000;
+constexpr ll adaptive_min_tail = 10;
+
+enum class AccumulatorMode { automatic,
+                             dense,
+                             banded };
+
+enum class KernelMode { automatic,
+                        sparse,
+                        bitset };
+
+struct Options {
+    bool text = false;
+    AccumulatorMode accumulator = AccumulatorMode::automatic;
+    KernelMode kernel = KernelMode::automatic;
+    // Number of independent random streams per job; with 1, the results
+    // are identical to a single sequential run.
+    int split = 1;
+    ll seed = default_seed;
+    // If positive, run random jobs in rounds of doubling size and stop when
+    // the quantiles of y/x at the given levels change by at most this much;
+    // iter is the maximum number of iterations.
+    double adaptive = 0;
+    vector<double> levels = {0.1, 0.01, 0.001};
+    // If nonempty, calculate exactly the inputs listed in this file ("-" for
+    // standard input) instead of all inputs without a sufficient output.
+    string jobs;
+    // If nonempty, coordinate with other processes through the queue
+    // directory of this name; see Driver::do_queue_work.
+    string queue;
+    ll lease = 300;
+};
 const fs::path data_dir = "type-ratio-data";
 const fs::path dir_in = fs::path(data_dir) / "in";
 const fs::path dir_out = fs::path(data_dir) / "out";
+const fs::path dir_queue = fs::path(data_dir) / "queue";
+
+// Identifies this process in queue mode.
+static const string &owner_id() {
+    static const string id = [] {
+        char host[256] = {};
+        gethostname(host, sizeof(host) - 1);
+        return string(host) + "." + std::to_string(getpid());
+    }();
+    return id;
+}
+
+template <typename T>
+static void write_le(ofstream &f, T v) {
+    char buf[sizeof(T)];
+    for (unsigned i = 0; i < sizeof(T); ++i) {
+        buf[i] = static_cast<char>((static_cast<std::uint64_t>(v) >> (8 * i)) & 0xff);
+    }
+    f.write(buf, sizeof(T));
+}
+
+template <typename T>
+static T read_le(ifstream &f) {
+    unsigned char buf[sizeof(T)];
+    f.read(reinterpret_cast<char *>(buf), sizeof(T));
+    std::uint64_t v = 0;
+    for (unsigned i = 0; i < sizeof(T); ++i) {
+        v |= static_cast<std::uint64_t>(buf[i]) << (8 * i);
+    }
+    return static_cast<T>(v);
+}
+
+// Accumulators count how many times each (x, y) was reached. The dense
+// accumulator stores all (mm+1) × (m0+1) counters. The banded accumulator
+// stores for each x only the range of y values reached so far, which is
+// usually a narrow band, and grows it on demand.
+template <typename T>
+class DenseAccumulator {
+  public:
+    DenseAccumulator(int rows, int cols_) : cols{cols_}, v(static_cast<std::size_t>(rows) * cols_) {}
+
+    inline void inc(int x, int y) { ++v[static_cast<std::size_t>(x) * cols + y]; }
+
+    inline void add(int x, int y, T w) { v[static_cast<std::size_t>(x) * cols + y] += w; }
+
+    inline ll get(int x, int y) const { return v[static_cast<std::size_t>(x) * cols + y]; }
+
+    pair<int, int> range(int x) const {
+        int first = 0;
+        while (first < cols && get(x, first) == 0) {
+            ++first;
+        }
+        int last = cols;
+        while (last > first && get(x, last - 1) == 0) {
+            --last;
+        }
+        if (first == last) {
+            first = last = 0;
+        }
+        return std::make_pair(first, last);
+    }
+
+  private:
+    const int cols;
+    vector<T> v;
+};
+
+template <typename T>
+class BandedAccumulator {
+  public:
+    BandedAccumulator(int rows_, int) : rows(rows_) {}
+
+    inline void inc(int x, int y) { add(x, y, 1); }
+
+    inline void add(int x, int y, T w) {
+        Row &r = rows[x];
+        int i = y - r.first;
+        if (i < 0 || i >= static_cast<int>(r.v.size())) {
+            grow(r, y);
+            i = y - r.first;
+        }
+        r.v[i] += w;
+    }
+
+    inline ll get(int x, int y) const {
+        const Row &r = rows[x];
+        int i = y - r.first;
+        return (i >= 0 && i < static_cast<int>(r.v.size())) ? r.v[i] : 0;
+    }
+
+    pair<int, int> range(int x) const {
+        // Only reached cells are stored, so both ends are nonzero.
+        const Row &r = rows[x];
+        if (r.v.empty()) {
+            return std::make_pair(0, 0);
+        }
+        return std::make_pair(r.first, r.first + static_cast<int>(r.v.size()));
+    }
+
+  private:
+    struct Row {
+        int first = 0;
+        vector<T> v;
+    };
+
+    static void grow(Row &r, int y) {
+        if (r.v.empty()) {
+            r.first = y;
+            r.v.assign(1, 0);
+        } else if (y < r.first) {
+            r.v.insert(begin(r.v), r.first - y, 0);
+            r.first = y;
+        } else {
+            r.v.resize(y - r.first + 1, 0);
+        }
+    }
+
+    vector<Row> rows;
+};
+
+// Counters with only the nonzero range of each row.
+struct Table {
+    vector<int> first;
+    vector<vector<ll>> rows;
+
+    void add(const Table &other) {
+        for (std::size_t x = 0; x < rows.size(); ++x) {
+            const vector<ll> &v = other.rows[x];
+            if (v.empty()) {
+                continue;
+            }
+            vector<ll> &u = rows[x];
+            int a = other.first[x];
+            if (u.empty()) {
+                first[x] = a;
+                u = v;
+                continue;
+            }
+            if (a < first[x]) {
+                u.insert(begin(u), first[x] - a, 0);
+                first[x] = a;
+            }
+            int b = a + static_cast<int>(v.size());
+            if (b > first[x] + static_cast<int>(u.size())) {
+                u.resize(b - first[x], 0);
+            }
+            for (std::size_t i = 0; i < v.size(); ++i) {
+                u[a - first[x] + i] += v[i];
+            }
+        }
+    }
+};
 
 class Work {
   public:
-    explicit Work(string fn_, ll iter_) : fn{fn_}, iter{iter_} {}
+    explicit Work(string fn_, ll iter_, const Options &opt_) : fn{fn_}, iter{iter_}, opt{opt_} {}
 
-    void run() {
+    // Random jobs are split into streams that can be calculated in
+    // parallel; stream k uses its own generator seeded with (seed, k) and
+    // its own accumulator, and the results are added together in finish().
+    //
+    // The streams proceed in rounds. Without adaptive mode, there is only
+    // one round of iter iterations. In adaptive mode, the first round has
+    // adaptive_first_round iterations and each subsequent round doubles the
+    // total; as round sizes are multiples of the number of streams until
+    // the last one, the result is identical to a fixed run with the
+    // achieved number of iterations.
+    void prepare() {
         read_data();
+        find_duplicates();
+        check_size();
+        choose_kernel();
+        streams = small ? 1 : static_cast<int>(std::clamp<ll>(opt.split, 1, std::max<ll>(iter, 1)));
+        tables.resize(streams);
+        for (Table &t : tables) {
+            t.first.assign(mm + 1, 0);
+            t.rows.assign(mm + 1, {});
+        }
+        orders.assign(streams, vector<int>(n));
+        rngs.resize(streams);
+        for (int k = 0; k < streams; ++k) {
+            std::iota(begin(orders[k]), end(orders[k]), 0);
+            if (small) {
+                orders[k] = exact_order();
+            }
+            if (streams == 1) {
+                rngs[k].seed(opt.seed);
+            } else {
+                std::seed_seq seq{opt.seed, static_cast<ll>(k)};
+                rngs[k].seed(seq);
+            }
+        }
+        done = 0;
+        round = iter;
+        if (opt.adaptive > 0 && !small) {
+            ll first = (adaptive_first_round + streams - 1) / streams * streams;
+            round = std::min(iter, first);
+        }
+        pending = streams;
         msg("+");
-        calc();
-        msg("-");
+    }
+
+    int get_streams() const { return streams; }
+
+    // Returns true for the last stream to finish.
+    bool stream_done() {
+        int left;
+#pragma omp atomic capture
+        left = --pending;
+        return left == 0;
+    }
+
+    // Called when all streams have finished the current round; returns true
+    // if another round is needed.
+    bool next_round() {
+        done += round;
+        if (opt.adaptive <= 0 || small || done >= iter) {
+            return false;
+        }
+        merge();
+        vector<int> q = quantiles();
+        bool converged = !prev.empty() && tails_ok();
+        std::size_t w = 2 * opt.levels.size();
+        for (int x = 0; converged && x < mm + 1; ++x) {
+            for (std::size_t i = 0; i < w; ++i) {
+                std::size_t j = x * w + i;
+                if (q[j] != -2 && prev[j] != -2 && std::abs(q[j] - prev[j]) > opt.adaptive * x) {
+                    converged = false;
+                    break;
+                }
+            }
+        }
+        prev = std::move(q);
+        if (converged) {
+            return false;
+        }
+        round = std::min(done, iter - done);
+        pending = streams;
+        return true;
+    }
+
+    // Calculates all streams and rounds of the job in the calling thread and
+    // writes the output.
+    void calc_serial() {
+        do {
+            for (int k = 0; k < streams; ++k) {
+                calc_stream(k);
+                stream_done();
+            }
+        } while (next_round());
+        finish();
+    }
+
+    void finish() {
+        merge();
+        tables.clear();
+        orders.clear();
+        rngs.clear();
+        prev.clear();
+        data.clear();
+        words.clear();
         write_data();
+        // Reported after writing, so that the output can be read as soon
+        // as this line appears.
+        msg("-");
     }
 
     void read_data() {
         fs::path input = dir_in / fn;
         try {
-            ifstream f(input);
+            ifstream f(input, std::ios::binary);
             f.exceptions(ifstream::failbit | ifstream::badbit);
-            f >> n >> m0 >> m1;
-            mm = m0 + m1;
-            data.resize(n);
-            for (int i = 0; i < n; ++i) {
-                read_into(f, data[i], m0, 0);
-                read_into(f, data[i], m1, m0);
+            if (f.peek() == input_magic[0]) {
+                read_binary(f);
+            } else {
+                read_text(f);
             }
         } catch (const std::ios_base::failure &e) {
             throw std::ios_base::failure(input, e.code());
@@ -58,32 +408,59 @@ class Work {
     void write_data() {
         string fn2 = fn;
         if (!small) {
-            fn2 += "." + std::to_string(iter);
+            fn2 += "." + std::to_string(done);
+            if (opt.seed != default_seed) {
+                fn2 += ".s" + std::to_string(opt.seed);
+            }
         }
         fs::path output = dir_out / fn2;
+        // In queue mode, another process may be writing the same output
+        // after taking over an expired lock.
+        fs::path tmp = output;
+        if (!opt.queue.empty()) {
+            tmp = dir_queue / opt.queue / (fn2 + "." + owner_id() + ".tmp");
+        }
         try {
-            ofstream f(output);
+            ofstream f(tmp, std::ios::binary);
             f.exceptions(ofstream::failbit | ofstream::badbit);
-            for (int x = 0; x < mm + 1; ++x) {
-                pair<int, int> r = acc_range(x);
-                f << r.first << " " << r.second;
-                for (int y = r.first; y < r.second; ++y) {
-                    f << " " << get_acc(x, y);
-                }
-                f << "\n";
+            if (opt.text) {
+                write_text(f);
+            } else {
+                write_binary(f);
             }
         } catch (const std::ios_base::failure &e) {
             throw std::ios_base::failure(output, e.code());
         }
+        if (tmp != output) {
+            fs::rename(tmp, output);
+        }
     }
 
-    void calc() {
-        init_calc();
-        check_size();
-        if (small) {
-            calc_exact();
+    const string &get_fn() const { return fn; }
+
+    void calc_stream(int k) {
+        // Each permutation increments at most n counters.
+        ll perms = subsets ? 0 : small ? exact_orders
+                                       : stream_iter(k);
+        bool narrow = !subsets && perms <= static_cast<ll>(std::numeric_limits<std::uint32_t>::max()) / std::max(n, 1);
+        bool banded;
+        if (opt.accumulator == AccumulatorMode::automatic) {
+            banded = static_cast<ll>(mm + 1) * (m0 + 1) > dense_limit;
         } else {
-            calc_random();
+            banded = opt.accumulator == AccumulatorMode::banded;
+        }
+        if (banded) {
+            if (narrow) {
+                calc_with<BandedAccumulator<std::uint32_t>>(k);
+            } else {
+                calc_with<BandedAccumulator<ll>>(k);
+            }
+        } else {
+            if (narrow) {
+                calc_with<DenseAccumulator<std::uint32_t>>(k);
+            } else {
+                calc_with<DenseAccumulator<ll>>(k);
+            }
         }
     }
 
@@ -96,6 +473,92 @@ class Work {
         }
     }
 
+    void read_text(ifstream &f) {
+        f >> n >> m0 >> m1;
+        mm = m0 + m1;
+        data.resize(n);
+        for (int i = 0; i < n; ++i) {
+            read_into(f, data[i], m0, 0);
+            read_into(f, data[i], m1, m0);
+        }
+    }
+
+    void read_binary(ifstream &f) {
+        char magic[4];
+        f.read(magic, 4);
+        if (!std::equal(magic, magic + 4, input_magic) || read_le<std::int32_t>(f) != format_version) {
+            throw std::ios_base::failure("unsupported input format");
+        }
+        n = read_le<std::int32_t>(f);
+        m0 = read_le<std::int32_t>(f);
+        m1 = read_le<std::int32_t>(f);
+        mm = m0 + m1;
+        int nnz = read_le<std::int32_t>(f);
+        vector<int> offsets(n + 1);
+        for (int i = 0; i < n + 1; ++i) {
+            offsets[i] = read_le<std::int32_t>(f);
+        }
+        assert(offsets[0] == 0 && offsets[n] == nnz);
+        data.resize(n);
+        for (int i = 0; i < n; ++i) {
+            assert(offsets[i] <= offsets[i + 1]);
+            for (int j = offsets[i]; j < offsets[i + 1]; ++j) {
+                int a = read_le<std::int32_t>(f);
+                assert(0 <= a && a < mm);
+                data[i].push_back(a);
+            }
+        }
+    }
+
+    void write_text(ofstream &f) const {
+        for (int x = 0; x < mm + 1; ++x) {
+            pair<int, int> r = acc_range(x);
+            f << r.first << " " << r.second;
+            for (int y = r.first; y < r.second; ++y) {
+                f << " " << get_acc(x, y);
+            }
+            f << "\n";
+        }
+    }
+
+    void write_binary(ofstream &f) const {
+        vector<pair<int, int>> ranges(mm + 1);
+        ll band = 0;
+        for (int x = 0; x < mm + 1; ++x) {
+            ranges[x] = acc_range(x);
+            band += ranges[x].second - ranges[x].first;
+        }
+        ll dense = static_cast<ll>(mm + 1) * (m0 + 1);
+        bool banded = band + mm + 1 < dense;
+        f.write(output_magic, 4);
+        write_le<std::int32_t>(f, format_version);
+        write_le<std::int32_t>(f, banded ? layout_banded : layout_dense);
+        write_le<std::int32_t>(f, streams > 1 ? streams : 0);
+        write_le<std::int64_t>(f, mm + 1);
+        write_le<std::int64_t>(f, m0 + 1);
+        write_le<std::int64_t>(f, small ? 0 : done);
+        write_le<std::int64_t>(f, small ? 0 : opt.seed);
+        if (banded) {
+            for (int x = 0; x < mm + 1; ++x) {
+                write_le<std::int32_t>(f, ranges[x].first);
+            }
+            for (int x = 0; x < mm + 1; ++x) {
+                write_le<std::int32_t>(f, ranges[x].second);
+            }
+            for (int x = 0; x < mm + 1; ++x) {
+                for (int y = ranges[x].first; y < ranges[x].second; ++y) {
+                    write_le<std::int64_t>(f, get_acc(x, y));
+                }
+            }
+        } else {
+            for (int x = 0; x < mm + 1; ++x) {
+                for (int y = 0; y < m0 + 1; ++y) {
+                    write_le<std::int64_t>(f, get_acc(x, y));
+                }
+            }
+        }
+    }
+
     static void read_into(ifstream &f, vector<int> &v, int range, int base) {
         while (true) {
             int a;
@@ -108,47 +571,347 @@ class Work {
         }
     }
 
-    void init_calc() {
-        order.resize(n);
-        accum.resize((m0 + 1) * (mm + 1));
-        seen.resize(mm);
-        for (int j = 0; j < n; ++j) {
-            order[j] = j;
+    // Groups samples with identical types: classes[c] is the first sample
+    // of class c and mult[c] is the number of samples in it. Such samples
+    // are interchangeable, so exact calculations only need to consider
+    // which class is where.
+    void find_duplicates() {
+        classes.clear();
+        mult.clear();
+        std::map<vector<int>, int> index;
+        for (int i = 0; i < n; ++i) {
+            vector<int> key = data[i];
+            std::sort(begin(key), end(key));
+            auto r = index.emplace(std::move(key), static_cast<int>(classes.size()));
+            if (r.second) {
+                classes.push_back(i);
+                mult.push_back(0);
+            }
+            ++mult[r.first->second];
+        }
+    }
+
+    // Number of sub-multisets of samples, or limit + 1 if it is larger.
+    ll count_subsets(ll limit) const {
+        ll count = 1;
+        for (int m : mult) {
+            if (count > limit / (m + 1)) {
+                return limit + 1;
+            }
+            count *= m + 1;
+        }
+        return count;
+    }
+
+    // Number of distinct orders of samples, n! / (mult[0]! mult[1]! ...),
+    // or limit + 1 if it is larger.
+    ll count_orders(ll limit) const {
+        ll count = 1;
+        ll s = 0;
+        for (int m : mult) {
+            for (int j = 1; j <= m; ++j) {
+                ++s;
+                if (count > limit * j / s) {
+                    return limit + 1;
+                }
+                // count * binomial(s, j) is an integer at each step.
+                count = count * s / j;
+            }
+        }
+        return count;
+    }
+
+    // The first distinct order of samples, with each sample replaced by
+    // the first sample of its class.
+    vector<int> exact_order() const {
+        vector<int> order;
+        for (std::size_t c = 0; c < classes.size(); ++c) {
+            order.insert(end(order), mult[c], classes[c]);
+        }
+        return order;
+    }
+
+    // Iterations of stream k in the current round.
+    ll stream_iter(int k) const {
+        return round / streams + (k < round % streams ? 1 : 0);
+    }
+
+    template <typename Acc>
+    void calc_with(int k) {
+        Acc acc(mm + 1, m0 + 1);
+        if (subsets) {
+            calc_subsets(acc);
+        } else if (bitset) {
+            vector<word_t> seen(nwords);
+            calc_orders(acc, k, seen);
+        } else {
+            vector<flag_t> seen(mm);
+            calc_orders(acc, k, seen);
+        }
+        if (done == 0) {
+            store_acc(acc, tables[k], subsets ? 1 : exact_weight);
+        } else {
+            Table t;
+            store_acc(acc, t);
+            tables[k].add(t);
+        }
+    }
+
+    void merge() {
+        result = tables[0];
+        for (int k = 1; k < streams; ++k) {
+            result.add(tables[k]);
+        }
+    }
+
+    // For each x and level, the lower and upper quantiles of y in result,
+    // defined as in Curve.quantiles in type_ratio.py; -2 if the row has too
+    // few permutations to resolve the tails at this level. Rare values of x
+    // are not expected to converge.
+    vector<int> quantiles() const {
+        vector<int> q;
+        q.reserve((mm + 1) * 2 * opt.levels.size());
+        for (int x = 0; x < mm + 1; ++x) {
+            const vector<ll> &v = result.rows[x];
+            int first = result.first[x];
+            ll tot = 0;
+            for (ll c : v) {
+                tot += c;
+            }
+            for (double level : opt.levels) {
+                if (tot * level < adaptive_min_tail) {
+                    q.push_back(-2);
+                    q.push_back(-2);
+                    continue;
+                }
+                // Before the band, cum is 0; after it, cum is tot.
+                double a = tot * level;
+                double b = tot * (1.0 - level);
+                int low = first;
+                int up = first;
+                ll cum = 0;
+                for (std::size_t i = 0; i < v.size(); ++i) {
+                    cum += v[i];
+                    if (cum <= a) {
+                        ++low;
+                    }
+                    if (cum < b && first + static_cast<int>(i) < m0) {
+                        ++up;
+                    }
+                }
+                q.push_back(low);
+                q.push_back(up);
+            }
         }
+        return q;
+    }
+
+    bool tails_ok() const {
+        for (double level : opt.levels) {
+            if (done * level < adaptive_min_tail) {
+                return false;
+            }
+        }
+        return true;
+    }
+
+    template <typename Acc>
+    void store_acc(const Acc &acc, Table &t, ll weight = 1) const {
+        t.first.resize(mm + 1);
+        t.rows.resize(mm + 1);
         for (int x = 0; x < mm + 1; ++x) {
-            for (int y = 0; y < m0 + 1; ++y) {
-                clear_acc(x, y);
+            pair<int, int> r = acc.range(x);
+            t.first[x] = r.first;
+            t.rows[x].resize(r.second - r.first);
+            for (int y = r.first; y < r.second; ++y) {
+                t.rows[x][y - r.first] = acc.get(x, y) * weight;
             }
         }
     }
 
+    // Exact results are calculated by enumerating all distinct orders of
+    // samples or, usually much faster, by summing over the subsets of
+    // samples (see calc_subsets), if it is at most exact_preference times
+    // as expensive as iter random permutations. One step over subsets costs
+    // about 1/n of one permutation. Duplicate samples reduce the number of
+    // distinct orders to n! / (mult[0]! mult[1]! ...) and the number of
+    // subsets to (mult[0] + 1) (mult[1] + 1) ...; each distinct order
+    // stands for exact_weight permutations.
     void check_size() {
         small = false;
-        ll perm = 1;
+        subsets = false;
+        exact_weight = 1;
+        ll limit = exact_preference * iter;
+        if (n >= 3 && n <= subset_max_n && count_subsets(limit * n) <= limit * n) {
+            small = true;
+            subsets = true;
+            return;
+        }
+        exact_orders = count_orders(limit);
+        if (exact_orders > limit) {
+            return;
+        }
+        small = true;
+        if (n <= subset_unscaled_n) {
+            for (int m : mult) {
+                for (int j = 2; j <= m; ++j) {
+                    exact_weight *= j;
+                }
+            }
+        }
+    }
+
+    // The first k samples of a permutation are a given k-subset in k!(n-k)!
+    // permutations, so it is enough to visit each nonempty subset once and
+    // add this weight to the counter of its (x, y). Duplicate samples are
+    // handled by choosing only the number c of samples from each class of
+    // m samples, with an additional weight of binomial(m, c). The subsets
+    // are visited in reflected mixed-radix Gray code order, adding or
+    // removing one sample at a time.
+    template <typename Acc>
+    void calc_subsets(Acc &acc) const {
+        using u128 = unsigned __int128;
+        vector<u128> fact(n + 2);
+        fact[0] = 1;
+        for (int i = 1; i <= n + 1; ++i) {
+            fact[i] = fact[i - 1] * i;
+        }
+        // The weights of all subsets add up to (n+1)!; if that does not fit
+        // in the counters, the weights are scaled down and rounded. Only the
+        // relative values matter for the distribution of y.
+        u128 scale = 1;
+        if (n > subset_unscaled_n) {
+            const u128 limit = u128(1) << 60;
+            scale = (fact[n + 1] + limit - 1) / limit;
+        }
+        int nc = static_cast<int>(classes.size());
+        vector<int> chosen(nc, 0);
+        vector<int> dir(nc, 1);
+        vector<int> count(mm, 0);
+        // Product of binomial(mult[c], chosen[c]), at most 2^n.
+        ll b = 1;
+        int x = 0;
+        int y = 0;
+        int k = 0;
+        while (true) {
+            int c = 0;
+            while (c < nc && chosen[c] == (dir[c] > 0 ? mult[c] : 0)) {
+                dir[c] = -dir[c];
+                ++c;
+            }
+            if (c == nc) {
+                break;
+            }
+            int m = mult[c];
+            int h = chosen[c];
+            if (dir[c] > 0) {
+                b = b * (m - h) / (h + 1);
+                ++chosen[c];
+                ++k;
+            } else {
+                b = b * h / (m - h + 1);
+                --chosen[c];
+                --k;
+            }
+            if (h == 0 && dir[c] > 0) {
+                for (int v : data[classes[c]]) {
+                    if (count[v]++ == 0) {
+                        ++x;
+                        if (v < m0) {
+                            ++y;
+                        }
+                    }
+                }
+            } else if (h == 1 && dir[c] < 0) {
+                for (int v : data[classes[c]]) {
+                    if (--count[v] == 0) {
+                        --x;
+                        if (v < m0) {
+                            --y;
+                        }
+                    }
+                }
+            }
+            u128 w = fact[k] * fact[n - k] * static_cast<u128>(b);
+            acc.add(x, y, static_cast<ll>(scale == 1 ? w : (w + scale / 2) / scale));
+        }
+    }
+
+    // The sparse kernel keeps one flag per type and goes through the types
+    // of each sample one by one. The bitset kernel stores each sample as the
+    // nonzero words of a bitset over types and processes 64 types at a time:
+    // the newly seen types are the bits of a word not seen before, x grows
+    // by their number, and y grows by the number of those among the first
+    // m0 types.
+    void choose_kernel() {
+        ll nnz = 0;
+        ll nnzw = 0;
+        for (const vector<int> &vec : data) {
+            nnz += vec.size();
+            vector<int> w;
+            for (int v : vec) {
+                w.push_back(v / word_bits);
+            }
+            std::sort(begin(w), end(w));
+            nnzw += std::unique(begin(w), end(w)) - begin(w);
+        }
+        if (subsets) {
+            bitset = false;
+        } else if (opt.kernel == KernelMode::automatic) {
+            bitset = nnz >= bitset_density * nnzw || mm > nnz;
+        } else {
+            bitset = opt.kernel == KernelMode::bitset;
+        }
+        if (!bitset) {
+            return;
+        }
+        nwords = (mm + word_bits - 1) / word_bits;
+        words.assign(n, {});
         for (int i = 0; i < n; ++i) {
-            perm *= (i + 1);
-            if (perm > exact_preference * iter) {
-                return;
+            for (int v : data[i]) {
+                int w = v / word_bits;
+                word_t bit = word_t(1) << (v % word_bits);
+                vector<Word> &ws = words[i];
+                auto it = std::find_if(begin(ws), end(ws), [w](const Word &a) { return a.index == w; });
+                if (it == end(ws)) {
+                    ws.push_back({w, 0, 0});
+                    it = end(ws) - 1;
+                }
+                it->bits |= bit;
+                if (v < m0) {
+                    it->bits0 |= bit;
+                }
             }
+            std::sort(begin(words[i]), end(words[i]), [](const Word &a, const Word &b) { return a.index < b.index; });
         }
-        small = true;
     }
 
-    void calc_random() {
-        rng.seed(1);
-        for (ll it = 0; it < iter; ++it) {
+    template <typename Acc, typename Seen>
+    void calc_orders(Acc &acc, int k, Seen &seen) {
+        if (small) {
+            calc_exact(acc, orders[k], seen);
+        } else {
+            calc_random(acc, orders[k], seen, rngs[k], stream_iter(k));
+        }
+    }
+
+    template <typename Acc, typename Seen>
+    void calc_random(Acc &acc, vector<int> &order, Seen &seen, rng_t &rng, ll count) const {
+        for (ll it = 0; it < count; ++it) {
             shuffle(begin(order), end(order), rng);
-            process_order();
+            process_order(acc, order, seen);
         }
     }
 
-    void calc_exact() {
+    template <typename Acc, typename Seen>
+    void calc_exact(Acc &acc, vector<int> &order, Seen &seen) const {
         do {
-            process_order();
+            process_order(acc, order, seen);
         } while (std::next_permutation(begin(order), end(order)));
     }
 
-    inline void process_order() {
+    template <typename Acc>
+    inline void process_order(Acc &acc, const vector<int> &order, vector<flag_t> &seen) const {
         for (int i = 0; i < mm; ++i) {
             seen[i] = 0;
         }
@@ -165,55 +928,89 @@ class Work {
                     }
                 }
             }
-            inc_acc(x, y);
+            acc.inc(x, y);
         }
     }
 
-    inline ll get_acc(int x, int y) const { return accum[x * (m0 + 1) + y]; }
-
-    inline pair<int, int> acc_range(int x) const {
-        int first = 0;
-        while (first < m0 + 1 && get_acc(x, first) == 0) {
-            ++first;
-        }
-        int last = m0 + 1;
-        while (last > first && get_acc(x, last - 1) == 0) {
-            --last;
-        }
-        if (first == last) {
-            first = last = 0;
+    template <typename Acc>
+    inline void process_order(Acc &acc, const vector<int> &order, vector<word_t> &seen) const {
+        std::fill(begin(seen), end(seen), 0);
+        int x = 0;
+        int y = 0;
+        for (int j = 0; j < n; ++j) {
+            for (const Word &w : words[order[j]]) {
+                word_t fresh = w.bits & ~seen[w.index];
+                seen[w.index] |= w.bits;
+                x += __builtin_popcountll(fresh);
+                y += __builtin_popcountll(fresh & w.bits0);
+            }
+            acc.inc(x, y);
         }
-        return std::make_pair(first, last);
     }
 
-    inline void inc_acc(int x, int y) { ++accum[x * (m0 + 1) + y]; }
+    inline ll get_acc(int x, int y) const {
+        int i = y - result.first[x];
+        return (i >= 0 && i < static_cast<int>(result.rows[x].size())) ? result.rows[x][i] : 0;
+    }
 
-    inline void clear_acc(int x, int y) { accum[x * (m0 + 1) + y] = 0; }
+    inline pair<int, int> acc_range(int x) const {
+        int first = result.first[x];
+        return std::make_pair(first, first + static_cast<int>(result.rows[x].size()));
+    }
 
     const string fn;
     const ll iter;
+    const Options opt;
     int n;
     int mm;
     int m0;
     int m1;
     bool small;
+    bool subsets;
+    ll exact_orders;
+    ll exact_weight;
+    bool bitset;
+    int nwords;
     vector<vector<int>> data;
-    vector<int> order;
-    vector<ll> accum;
-    vector<flag_t> seen;
-    rng_t rng;
+    // Nonzero words of the bitset of each sample and their bits for the
+    // first m0 types, for the bitset kernel.
+    struct Word {
+        int index;
+        word_t bits;
+        word_t bits0;
+    };
+    vector<vector<Word>> words;
+    vector<int> classes;
+    vector<int> mult;
+    int streams;
+    int pending;
+    ll done;
+    ll round;
+    vector<Table> tables;
+    vector<vector<int>> orders;
+    vector<rng_t> rngs;
+    vector<int> prev;
+    Table result;
 };
 
 class Driver {
   public:
-    explicit Driver(ll iter_, int mypart_, int parts_) : iter{iter_}, mypart{mypart_}, parts{parts_} {}
+    explicit Driver(ll iter_, int mypart_, int parts_, const Options &opt_) : iter{iter_}, mypart{mypart_}, parts{parts_}, opt{opt_} {}
 
     void run() {
         get_work();
-        do_work();
+        if (opt.queue.empty()) {
+            do_work();
+        } else {
+            do_queue_work();
+        }
     }
 
     void get_work() {
+        if (!opt.jobs.empty()) {
+            get_listed_work();
+            return;
+        }
         std::unordered_set<string> work_set;
         for (const auto &p : fs::directory_iterator(dir_in)) {
             string fn = p.path().filename();
@@ -249,19 +1046,290 @@ class Driver {
         std::sort(begin(todo), end(todo));
         work.reserve(todo.size());
         for (const auto &s : todo) {
-            work.emplace_back(s, iter);
+            work.emplace_back(s, iter, opt);
         }
     }
 
+    void get_listed_work() {
+        vector<string> todo;
+        std::ifstream file;
+        if (opt.jobs != "-") {
+            file.open(opt.jobs);
+            if (!file) {
+                throw std::ios_base::failure(opt.jobs);
+            }
+        }
+        std::istream &f = opt.jobs == "-" ? std::cin : file;
+        string fn;
+        while (f >> fn) {
+            if (in_this_part(fn)) {
+                todo.push_back(fn);
+            }
+        }
+        fs::create_directories(dir_out);
+        work.reserve(todo.size());
+        for (const auto &s : todo) {
+            work.emplace_back(s, iter, opt);
+        }
+    }
+
+    // Jobs are started lazily, when a thread has no streams of the jobs in
+    // progress left to calculate and fewer jobs than threads are in
+    // progress, so that only about one job per thread is in memory at a
+    // time. The streams of the jobs in progress are shared by all threads,
+    // so that a large job is split among the threads that would otherwise
+    // be idle.
     void do_work() {
         int n = work.size();
-#pragma omp parallel for schedule(dynamic)
-        for (int i = 0; i < n; ++i) {
-            work[i].run();
+        int next = 0;
+        int active = 0;
+        std::deque<pair<int, int>> tasks;
+        std::mutex tasks_mutex;
+        std::condition_variable tasks_cv;
+        std::exception_ptr error;
+#pragma omp parallel
+        {
+            int limit = omp_get_num_threads();
+            auto add_streams = [&](int i) {
+                {
+                    std::lock_guard<std::mutex> guard(tasks_mutex);
+                    for (int k = 0; k < work[i].get_streams(); ++k) {
+                        tasks.emplace_back(i, k);
+                    }
+                }
+                tasks_cv.notify_all();
+            };
+            try {
+                while (true) {
+                    int i;
+                    int k = -1;
+                    {
+                        std::unique_lock<std::mutex> lock(tasks_mutex);
+                        tasks_cv.wait(lock, [&] {
+                            return failed || !tasks.empty() || (next < n && active < limit) || (next == n && active == 0);
+                        });
+                        if (failed || (tasks.empty() && next == n && active == 0)) {
+                            break;
+                        }
+                        if (!tasks.empty()) {
+                            i = tasks.front().first;
+                            k = tasks.front().second;
+                            tasks.pop_front();
+                        } else {
+                            i = next++;
+                            ++active;
+                        }
+                    }
+                    Work &w = work[i];
+                    if (k < 0) {
+                        w.prepare();
+                        add_streams(i);
+                        continue;
+                    }
+                    w.calc_stream(k);
+                    if (!w.stream_done()) {
+                        continue;
+                    }
+                    if (w.next_round()) {
+                        add_streams(i);
+                        continue;
+                    }
+                    w.finish();
+                    {
+                        std::lock_guard<std::mutex> guard(tasks_mutex);
+                        --active;
+                    }
+                    tasks_cv.notify_all();
+                }
+            } catch (...) {
+                std::lock_guard<std::mutex> guard(tasks_mutex);
+                if (!error) {
+                    error = std::current_exception();
+                }
+                failed = true;
+                tasks_cv.notify_all();
+            }
+        }
+        if (error) {
+            std::rethrow_exception(error);
+        }
+    }
+
+    // Queue mode: several processes, possibly on different machines, share
+    // type-ratio-data and claim jobs through lock files in
+    // dir_queue/NAME. A job is claimed by creating NAME/job.lock with
+    // O_EXCL. While it is being calculated, the owner keeps refreshing the
+    // modification time of the lock; a lock that has not been refreshed
+    // for opt.lease seconds belongs to a crashed process and can be taken
+    // over. When a job is finished, its lock is renamed to job.done.
+    //
+    // Jobs are claimed largest first. Each thread claims one job at a time,
+    // calculates it, releases its lock and claims the next one, so the large
+    // jobs start early and the small ones fill the gaps on the other
+    // threads. When all remaining jobs are locked by others, a thread waits
+    // until they are done or their leases expire. In this mode, the streams
+    // of a job are calculated by the thread that claimed it.
+    void do_queue_work() {
+        queue = dir_queue / opt.queue;
+        fs::create_directories(queue);
+        vector<pair<std::uintmax_t, string>> by_size;
+        for (const Work &w : work) {
+            by_size.emplace_back(fs::file_size(dir_in / w.get_fn()), w.get_fn());
+        }
+        std::sort(by_size.rbegin(), by_size.rend());
+        work.clear();
+        todo.clear();
+        for (const auto &p : by_size) {
+            todo.push_back(p.second);
+        }
+        std::thread heartbeat(&Driver::refresh_locks, this);
+        std::exception_ptr error;
+#pragma omp parallel
+        {
+            try {
+                string fn;
+                while (next_job(fn)) {
+                    Work w(fn, iter, opt);
+                    w.prepare();
+                    w.calc_serial();
+                    release(fn);
+                }
+            } catch (...) {
+#pragma omp critical
+                {
+                    if (!error) {
+                        error = std::current_exception();
+                    }
+                }
+                failed = true;
+            }
+        }
+        stop_heartbeat(heartbeat);
+        if (error) {
+            std::rethrow_exception(error);
         }
     }
 
   private:
+    fs::path lock_path(const string &fn) const { return queue / (fn + ".lock"); }
+
+    // Claims the largest remaining job and returns true, or returns false if
+    // there are no jobs left for this process.
+    bool next_job(string &fn) {
+        while (!failed) {
+            {
+                std::lock_guard<std::mutex> guard(todo_mutex);
+                vector<string> remaining;
+                for (const string &f : todo) {
+                    if (!fs::exists(queue / (f + ".done"))) {
+                        remaining.push_back(f);
+                    }
+                }
+                todo = std::move(remaining);
+                if (todo.empty()) {
+                    return false;
+                }
+                for (auto it = todo.begin(); it != todo.end(); ++it) {
+                    if (claim(*it)) {
+                        fn = *it;
+                        todo.erase(it);
+                        return true;
+                    }
+                }
+            }
+            std::this_thread::sleep_for(std::chrono::seconds(std::clamp<ll>(opt.lease / 4, 1, 10)));
+        }
+        return false;
+    }
+
+    bool create_lock(const string &fn) {
+        fs::path lock = lock_path(fn);
+        int fd = open(lock.c_str(), O_WRONLY | O_CREAT | O_EXCL, 0644);
+        if (fd < 0) {
+            if (errno == EEXIST) {
+                return false;
+            }
+            throw std::system_error(errno, std::generic_category(), lock);
+        }
+        string id = owner_id() + "\n";
+        bool ok = write(fd, id.data(), id.size()) == static_cast<ssize_t>(id.size());
+        close(fd);
+        if (!ok) {
+            throw std::system_error(errno, std::generic_category(), lock);
+        }
+        std::lock_guard<std::mutex> guard(locks_mutex);
+        locks.insert(fn);
+        return true;
+    }
+
+    bool claim(const string &fn) {
+        if (create_lock(fn)) {
+            return true;
+        }
+        fs::path lock = lock_path(fn);
+        std::error_code ec;
+        auto mtime = fs::last_write_time(lock, ec);
+        if (ec || fs::file_time_type::clock::now() - mtime < std::chrono::seconds(opt.lease)) {
+            return false;
+        }
+        // The lease has expired. Only one process can move the lock away;
+        // then whoever is first to create a new lock gets the job.
+        fs::path stale = queue / (fn + "." + owner_id() + ".stale");
+        fs::rename(lock, stale, ec);
+        if (ec) {
+            return false;
+        }
+        fs::remove(stale, ec);
+        if (fs::exists(queue / (fn + ".done"))) {
+            return false;
+        }
+        msg_queue("taking over", fn);
+        return create_lock(fn);
+    }
+
+    void release(const string &fn) {
+        {
+            std::lock_guard<std::mutex> guard(locks_mutex);
+            locks.erase(fn);
+        }
+        std::error_code ec;
+        fs::rename(lock_path(fn), queue / (fn + ".done"), ec);
+        if (ec) {
+            // Someone else took over the job; mark it done anyway.
+            std::ofstream(queue / (fn + ".done"));
+        }
+    }
+
+    void refresh_locks() {
+        std::unique_lock<std::mutex> guard(locks_mutex);
+        auto interval = std::chrono::seconds(std::max<ll>(opt.lease / 4, 1));
+        while (!stopping) {
+            if (locks_cv.wait_for(guard, interval, [this] { return stopping; })) {
+                break;
+            }
+            for (const string &fn : locks) {
+                std::error_code ec;
+                fs::last_write_time(lock_path(fn), fs::file_time_type::clock::now(), ec);
+            }
+        }
+    }
+
+    void stop_heartbeat(std::thread &heartbeat) {
+        {
+            std::lock_guard<std::mutex> guard(locks_mutex);
+            stopping = true;
+        }
+        locks_cv.notify_all();
+        heartbeat.join();
+    }
+
+    static void msg_queue(const char *what, const string &fn) {
+#pragma omp critical
+        {
+            std::cout << what << " " << fn << std::endl;
+        }
+    }
+
     bool in_this_part(string &s) {
         int hash = 0;
         for (char c : s) {
@@ -275,25 +1343,123 @@ class Driver {
     const ll iter;
     const int mypart;
     const int parts;
+    const Options opt;
     vector<Work> work;
+    fs::path queue;
+    // Jobs in queue mode that are not done or claimed by this process.
+    vector<string> todo;
+    std::mutex todo_mutex;
+    std::atomic<bool> failed = false;
+    std::mutex locks_mutex;
+    std::condition_variable locks_cv;
+    std::unordered_set<string> locks;
+    bool stopping = false;
 };
 
 } // namespace type_ratio
 
+static void usage(const char *prog) {
+    std::cerr << "usage: " << prog << " [--text] [--accumulator=auto|dense|banded] [--kernel=auto|sparse|bitset] [--split=N] [--seed=S] [--adaptive=TOL] [--levels=L,...] [--jobs=FILE] [--queue=NAME [--lease=SECONDS]] ITER [PART-NUMBER NUMBER-OF-PARTS]" << std::endl;
+    std::exit(1);
+}
+
 int main(int argc, const char **argv) {
-    if (argc != 2 && argc != 4) {
-        std::cerr << "usage: " << argv[0] << " ITER [PART-NUMBER NUMBER-OF-PARTS]" << std::endl;
-        std::exit(1);
+    type_ratio::Options opt;
+    std::vector<std::string> args;
+    for (int i = 1; i < argc; ++i) {
+        std::string arg = argv[i];
+        if (arg == "--text") {
+            opt.text = true;
+        } else if (arg == "--accumulator=auto") {
+            opt.accumulator = type_ratio::AccumulatorMode::automatic;
+        } else if (arg == "--accumulator=dense") {
+            opt.accumulator = type_ratio::AccumulatorMode::dense;
+        } else if (arg == "--accumulator=banded") {
+            opt.accumulator = type_ratio::AccumulatorMode::banded;
+        } else if (arg == "--kernel=auto") {
+            opt.kernel = type_ratio::KernelMode::automatic;
+        } else if (arg == "--kernel=sparse") {
+            opt.kernel = type_ratio::KernelMode::sparse;
+        } else if (arg == "--kernel=bitset") {
+            opt.kernel = type_ratio::KernelMode::bitset;
+        } else if (arg.rfind("--split=", 0) == 0) {
+            try {
+                opt.split = std::stoi(arg.substr(8));
+            } catch (const std::logic_error &e) {
+                usage(argv[0]);
+            }
+            if (opt.split < 1) {
+                usage(argv[0]);
+            }
+        } else if (arg.rfind("--seed=", 0) == 0) {
+            try {
+                opt.seed = std::stoll(arg.substr(7));
+            } catch (const std::logic_error &e) {
+                usage(argv[0]);
+            }
+            if (opt.seed < 1) {
+                usage(argv[0]);
+            }
+        } else if (arg.rfind("--adaptive=", 0) == 0) {
+            try {
+                opt.adaptive = std::stod(arg.substr(11));
+            } catch (const std::logic_error &e) {
+                usage(argv[0]);
+            }
+            if (!(opt.adaptive > 0)) {
+                usage(argv[0]);
+            }
+        } else if (arg.rfind("--levels=", 0) == 0) {
+            opt.levels.clear();
+            std::istringstream ss(arg.substr(9));
+            std::string level;
+            while (std::getline(ss, level, ',')) {
+                try {
+                    opt.levels.push_back(std::stod(level));
+                } catch (const std::logic_error &e) {
+                    usage(argv[0]);
+                }
+                if (!(0 < opt.levels.back() && opt.levels.back() < 1)) {
+                    usage(argv[0]);
+                }
+            }
+        } else if (arg.rfind("--queue=", 0) == 0) {
+            opt.queue = arg.substr(8);
+            if (opt.queue.empty() || opt.queue.find('/') != std::string::npos) {
+                usage(argv[0]);
+            }
+        } else if (arg.rfind("--lease=", 0) == 0) {
+            try {
+                opt.lease = std::stoll(arg.substr(8));
+            } catch (const std::logic_error &e) {
+                usage(argv[0]);
+            }
+            if (opt.lease < 1) {
+                usage(argv[0]);
+            }
+        } else if (arg.rfind("--jobs=", 0) == 0) {
+            opt.jobs = arg.substr(7);
+            if (opt.jobs.empty()) {
+                usage(argv[0]);
+            }
+        } else if (arg.rfind("--", 0) == 0) {
+            usage(argv[0]);
+        } else {
+            args.push_back(arg);
+        }
+    }
+    if (args.size() != 1 && args.size() != 3) {
+        usage(argv[0]);
     }
 
     long long iter;
     int mypart = 0;
     int parts = 1;
     try {
-        iter = std::stoll(argv[1]);
-        if (argc == 4) {
-            mypart = std::stoi(argv[2]);
-            parts = std::stoi(argv[3]);
+        iter = std::stoll(args[0]);
+        if (args.size() == 3) {
+            mypart = std::stoi(args[1]);
+            parts = std::stoi(args[2]);
         }
     } catch (const std::logic_error &e) {
         std::cerr << "invalid argument" << std::endl;
@@ -309,7 +1475,7 @@ int main(int argc, const char **argv) {
     }
 
     try {
-        type_ratio::Driver d(iter, mypart, parts);
+        type_ratio::Driver d(iter, mypart, parts, opt);
         d.run();
     } catch (const std::system_error &e) {
         std::cerr << e.what() << std::endl;
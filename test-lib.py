@@ -1,7 +1,13 @@
 #!/usr/bin/env python3
 
+import contextlib
+import json
 import logging
+import numpy as np
+import os
 import random
+import shutil
+import tempfile
 import type_ratio
 
 logging.basicConfig(format='%(relativeCreated)8d %(levelname)s %(message)s',
@@ -63,7 +69,7 @@ def get_test_data1():
     ]
 
 
-def get_test_data2(pp):
+def get_test_data2(pp, count=100):
     random.seed(0)
     tokens1a = [f'ta{i}' for i in range(200)]
     tokens1b = [f'tb{i}' for i in range(200)]
@@ -71,7 +77,7 @@ def get_test_data2(pp):
     tokens2b = [f'TB{i}' for i in range(200)]
     samplelist = []
     for p in [p1, p2, p3, p4]:
-        for i in range(100):
+        for i in range(count):
             for c in ['X', 'Y']:
                 tokens1 = random_subset(tokens1a, pp[
                     (c, 1)][0]) + random_subset(tokens1b, pp[(c, 1)][1])
@@ -81,16 +87,325 @@ def get_test_data2(pp):
     return samplelist
 
 
-def run(name, samplelist, dir_result=None):
-    driver = type_ratio.Driver(name, dir_result=dir_result)
+def write_tokens(samplelist, filename):
+    with open(filename, 'w') as f:
+        print('sample\tperiods\tcolls\tdataset\ttype', file=f)
+        for s in samplelist:
+            periods = ','.join(f'{a}-{b}' for a, b in sorted(s.periods))
+            colls = ','.join(sorted(s.colls))
+            for i in range(2):
+                for t, c in zip(s.types[i], s.counts[i]):
+                    t = type_ratio.vocabulary[t]
+                    for j in range(c):
+                        print(f'{s.label}\t{periods}\t{colls}\t{i}\t{t}',
+                              file=f)
+
+
+def read_tokens(samplelist, name, vocabulary=None):
+    os.makedirs('type-ratio-test', exist_ok=True)
+    filename = os.path.join('type-ratio-test', f'{name}.tsv')
+    write_tokens(samplelist, filename)
+    if vocabulary is not None:
+        type_ratio.set_vocabulary(vocabulary)
+    return type_ratio.read_samples(filename)
+
+
+def compare(name1, name2, fn, dir1='.'):
+    fn1 = os.path.join(dir1, f'type-ratio-result-{name1}', fn)
+    with open(fn1) as f1:
+        with open(os.path.join(f'type-ratio-result-{name2}', fn)) as f2:
+            assert f1.read() == f2.read(), (name1, name2, fn)
+
+
+def compare_all(name1, name2):
+    """Checks that two result directories have the same files with the same
+    bytes, apart from timings.json."""
+    dir1 = f'type-ratio-result-{name1}'
+    dir2 = f'type-ratio-result-{name2}'
+    assert sorted(os.listdir(dir1)) == sorted(os.listdir(dir2)), (name1, name2)
+    for fn in os.listdir(dir1):
+        if fn == 'timings.json':
+            continue
+        with open(os.path.join(dir1, fn), 'rb') as f1:
+            with open(os.path.join(dir2, fn), 'rb') as f2:
+                assert f1.read() == f2.read(), (name1, name2, fn)
+
+
+def run(name,
+        samplelist,
+        dir_result=None,
+        engine=None,
+        workers=None,
+        iter=10000,
+        tolerance=None,
+        top_up=False,
+        metrics=None,
+        pipeline=False,
+        freq_top=(5, ),
+        render=True):
+    driver = type_ratio.Driver(name,
+                               dir_result=dir_result,
+                               engine=engine,
+                               workers=workers,
+                               metrics=metrics,
+                               pipeline=pipeline,
+                               freq_top=freq_top,
+                               render=render)
     colls = type_ratio.list_colls(samplelist)
     ts = type_ratio.TimeSeries(get_metadata(), colls, samplelist)
     driver.add_timeseries(ts)
-    driver.calc(10000)
+    driver.calc(iter, tolerance, top_up)
+    return driver
+
+
+def check_freq_top(name, top):
+    """Checks that freq-TOP.txt is freq.txt with only the first TOP types
+    of each list."""
+    expected = []
+    with open(os.path.join(f'type-ratio-result-{name}', 'freq.txt')) as f:
+        for line in f:
+            if line.startswith('    '):
+                count += 1
+                if count > top:
+                    continue
+            else:
+                count = 0
+            expected.append(line)
+    fn = os.path.join(f'type-ratio-result-{name}', f'freq-{top}.txt')
+    with open(fn) as f:
+        assert f.read() == ''.join(expected), fn
+
+
+SPEC = """
+[corpus]
+file = "test2a.tsv"
+
+[labels]
+title = "Example title"
+datasets = ["suffix1", "suffix2"]
+dataset_labels = ["Suffix 1", "Suffix 2"]
+xlabel = "Suffix 1 and 2 types"
+ylabel = "Proportion of suffix 1 types"
+
+[periods]
+list = [[1500, 1600], [1600, 1700], [1700, 1800], [1800, 1900]]
+highlight = [[1600, 1700]]
+tick_step = 100
+
+[collections.X]
+label = "Collection X"
+color = "#f26924"
+
+[collections.Y]
+label = "Collection Y"
+color = "#0088cc"
+
+[run]
+iter = {iter}
+
+[output]
+label = "{name}"
+"""
+
+
+@contextlib.contextmanager
+def empty_data():
+    """Runs in a temporary working directory, so that the results are
+    calculated from scratch and are not reused by other tests. Yields the
+    previous working directory."""
+    cwd = os.getcwd()
+    tmp = tempfile.mkdtemp(prefix='type-ratio-test-')
+    os.chdir(tmp)
+    try:
+        yield cwd
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(tmp)
+
+
+def write_spec(name, iter):
+    filename = os.path.join('type-ratio-test', f'{name}.toml')
+    with open(filename, 'w') as f:
+        f.write(SPEC.format(name=name, iter=iter))
+    return os.path.abspath(filename)
+
+
+def check_spec():
+    spec = write_spec('test2a-spec', 10000)
+    metadata, colls = type_ratio.spec_metadata(type_ratio.load_spec(spec), [])
+    # Without trend_yrange, the trend plots choose their own y range.
+    assert 'trend_yrange' not in metadata.__dict__
+    type_ratio.run_spec(spec)
+    for fn in ['summary.txt', 'freq.txt', 'freq-5.txt', 'tokens-X.js']:
+        compare('test2a', 'test2a-spec', fn)
+    assert sorted(os.listdir('type-ratio-result-test2a')) == sorted(
+        os.listdir('type-ratio-result-test2a-spec'))
+    # Each stage separately.
+    spec = write_spec('test2a-spec-stages', 10000)
+    with empty_data() as cwd:
+        estimate = type_ratio.run_spec(spec, dry_run=True)
+        assert estimate['cached'] == 0, estimate
+        assert [r['jobs'] for r in estimate['runs']] == [estimate['jobs']]
+        type_ratio.run_spec(spec, stage='prepare')
+        try:
+            type_ratio.run_spec(spec, stage='report')
+            assert False
+        except RuntimeError:
+            pass
+        type_ratio.run_spec(spec, stage='compute', jobs=2)
+        estimate = type_ratio.run_spec(spec, dry_run=True)
+        assert estimate['cached'] == estimate['jobs'], estimate
+        assert estimate['runs'] == [], estimate
+        type_ratio.main(['run', spec])
+        for fn in ['summary.txt', 'freq.txt']:
+            compare('test2a', 'test2a-spec-stages', fn, cwd)
+
+
+def check_numpy(pp):
+    """The NumPy engine calculates the same exact results as the C++ engine,
+    and random results that are close to them."""
+    with empty_data() as cwd:
+        run('test1-numpy', get_test_data1(), engine=type_ratio.NumpyEngine())
+        for fn in ['summary.txt', 'freq.txt']:
+            compare('test1', 'test1-numpy', fn, cwd)
+        assert all('.' not in fn for fn in os.listdir(type_ratio.DIR_OUT))
+        numpy = run('test3-numpy',
+                    get_test_data2(pp, 10),
+                    engine=type_ratio.NumpyEngine(),
+                    render=False)
+        outputs = os.listdir(type_ratio.DIR_OUT)
+        assert any(fn.endswith('.10000') for fn in outputs), outputs
+        with empty_data():
+            cc = run('test3-numpy', get_test_data2(pp, 10), render=False)
+        for curve1, curve2 in zip(numpy.curves, cc.curves):
+            for c1, c2 in zip(curve1.get_curves(), curve2.get_curves()):
+                # Only the x that most iterations pass through; the others
+                # have too few observations to compare.
+                xx = np.flatnonzero(np.minimum(c1.tot, c2.tot) >= 5000)
+                assert len(xx) > 0
+                assert np.all(np.abs(c1.means(xx) - c2.means(xx)) <= 1)
+                for level in [0.5, 0.1, 0.025]:
+                    for y1, y2 in zip(c1.quantiles(xx, level),
+                                      c2.quantiles(xx, level)):
+                        assert np.all(np.abs(y1 - y2) <= 2), (y1, y2)
+
+
+class CountingEngine(type_ratio.SubprocessEngine):
+
+    def __init__(self):
+        super().__init__()
+        self.runs = 0
+
+    def run(self, *args, **kwargs):
+        self.runs += 1
+        super().run(*args, **kwargs)
+
+
+def check_session(pps):
+    """Calculates several time series in one session, with the same results
+    as separately."""
+    with empty_data():
+        for i, pp in enumerate(pps):
+            run(f'session{i}-separate', get_test_data2(pp, 20))
+        with empty_data() as separate:
+            engine = CountingEngine()
+            session = type_ratio.Session(engine)
+            records = [[] for pp in pps]
+            for i, pp in enumerate(pps):
+                driver = type_ratio.Driver(
+                    f'session{i}',
+                    metrics=lambda kind, record, i=i: records[i].append(
+                        (kind, record)))
+                samplelist = get_test_data2(pp, 20)
+                colls = type_ratio.list_colls(samplelist)
+                driver.add_timeseries(
+                    type_ratio.TimeSeries(get_metadata(), colls, samplelist))
+                session.add_driver(driver)
+            session.calc(10000)
+            assert engine.runs == 1, engine.runs
+            for i in range(len(pps)):
+                for fn in ['summary.txt', 'freq.txt', 'tokens.js']:
+                    compare(f'session{i}-separate', f'session{i}', fn,
+                            separate)
+                check_timings(f'session{i}', records[i])
+
+
+def check_top_up(driver, iter):
+    """Checks that the random results of the driver were extended to iter
+    iterations with a second seed."""
+    index = type_ratio.ResultIndex()
+    random = 0
+    for curve in driver.curves:
+        for c in curve.get_curves():
+            output, n = index.get(c.digest)
+            if n is None:
+                continue
+            random += 1
+            assert output == f'{c.digest}.{iter}', output
+            seeds = type_ratio.output_seeds(
+                os.path.join(type_ratio.DIR_OUT, output))
+            assert seeds == [1, 2], (output, seeds)
+    index.close()
+    assert random > 0
+
+
+def check_adaptive(driver, iter, tolerance):
+    """Checks that an adaptive run stopped early for some jobs and recorded
+    that their results are good enough, so that they are not calculated
+    again."""
+    index = type_ratio.ResultIndex()
+    early = 0
+    for curve in driver.curves:
+        for c in curve.get_curves():
+            output, n, t, max_iter = index.db.execute(
+                '''SELECT output, iter, tolerance, max_iter FROM results
+                WHERE digest = ?''', (c.digest, )).fetchone()
+            if n is not None and n < iter:
+                early += 1
+                assert output == f'{c.digest}.{n}', output
+                assert (t, max_iter) == (tolerance, iter), (t, max_iter)
+    index.close()
+    assert early > 0
+    estimate = driver.estimate(iter, tolerance)
+    assert estimate['cached'] == estimate['jobs'], estimate
+    assert estimate['runs'] == [], estimate
+
+
+def check_temp_files():
+    """Leftover temporary files of interrupted writes are ignored."""
+    with empty_data():
+        run('test1-temp', get_test_data1(), render=False)
+        for d in [type_ratio.DIR_IN, type_ratio.DIR_OUT]:
+            fn = os.listdir(d)[0]
+            with open(os.path.join(d, f'{fn}.tmp12345'), 'w') as f:
+                f.write('partial')
+        os.unlink(type_ratio.INDEX)
+        index = type_ratio.ResultIndex()
+        inputs = [
+            row[0] for row in index.db.execute('SELECT digest FROM results')
+        ]
+        index.close()
+        assert not any('.tmp' in fn for fn in inputs), inputs
+        assert all(len(l) == 1 for l in type_ratio.list_outputs().values())
+        run('test1-temp', get_test_data1(), render=False)
+
+
+def check_timings(name, records):
+    with open(os.path.join(f'type-ratio-result-{name}', 'timings.json')) as f:
+        timings = json.load(f)
+    stages = [r['stage'] for r in timings['stages']]
+    assert stages == [r['stage'] for k, r in records if k == 'stage'], stages
+    assert 'engine' in stages, stages
+    for r in timings['jobs']:
+        assert r['cached'] == (r['wall'] is None), r
 
 
 def main():
-    run('test1', get_test_data1())
+    records = []
+    run('test1',
+        get_test_data1(),
+        metrics=lambda kind, record: records.append((kind, record)))
+    check_timings('test1', records)
     run('test1', get_test_data1(), dir_result='test-custom-directory')
     run(
         'test2a',
@@ -101,24 +416,118 @@ def main():
             ('Y', 1): [0.1, 0.01],
             ('Y', 2): [0.1, 0.01],
         }))
-    run(
-        'test2b',
+    samplelist = read_tokens(
         get_test_data2({
-            # 1–2 difference but no X–Y difference
-            ('X', 1): [0.1, 0.0001],
+            ('X', 1): [0.1, 0.01],
             ('X', 2): [0.1, 0.01],
-            ('Y', 1): [0.1, 0.0001],
+            ('Y', 1): [0.1, 0.01],
             ('Y', 2): [0.1, 0.01],
-        }))
+        }), 'test2a')
+    run('test2a-tsv', samplelist, freq_top=(5, 20, 100))
+    compare('test2a', 'test2a-tsv', 'summary.txt')
+    compare('test2a', 'test2a-tsv', 'freq.txt')
+    compare('test2a', 'test2a-tsv', 'freq-5.txt')
+    check_spec()
+    for top in [5, 20, 100]:
+        check_freq_top('test2a-tsv', top)
+    compare('test2a', 'test2a-tsv', 'tokens-X.js')
+    vocabulary = type_ratio.vocabulary
+    typedict = type_ratio.TypeDict(
+        os.path.join('type-ratio-test', 'types.sqlite'))
+    run('test1-typedict', read_tokens(get_test_data1(), 'test1', typedict))
+    compare('test1', 'test1-typedict', 'summary.txt')
+    compare('test1', 'test1-typedict', 'freq.txt')
+    type_ratio.set_vocabulary(vocabulary)
+    typedict.close()
     run(
-        'test2c',
+        'test2b',
         get_test_data2({
-            # some X–Y difference
+            # 1–2 difference but no X–Y difference
             ('X', 1): [0.1, 0.0001],
             ('X', 2): [0.1, 0.01],
-            ('Y', 1): [0.1, 0.01],
+            ('Y', 1): [0.1, 0.0001],
             ('Y', 2): [0.1, 0.01],
         }))
+    pp = {
+        # some X–Y difference
+        ('X', 1): [0.1, 0.0001],
+        ('X', 2): [0.1, 0.01],
+        ('Y', 1): [0.1, 0.01],
+        ('Y', 2): [0.1, 0.01],
+    }
+    run('test2c', get_test_data2(pp), workers=2)
+    # Rendering in parallel gives the same files as rendering serially.
+    run('test2c-serial', get_test_data2(pp))
+    compare_all('test2c', 'test2c-serial')
+    check_adaptive(
+        run('test2d-adaptive',
+            get_test_data2({
+                ('X', 1): [0.2, 0.01],
+                ('X', 2): [0.1, 0.01],
+                ('Y', 1): [0.1, 0.01],
+                ('Y', 2): [0.2, 0.01],
+            }),
+            iter=100000,
+            tolerance=0.05), 100000, 0.05)
+    pp = {
+        ('X', 1): [0.1, 0.01],
+        ('X', 2): [0.1, 0.01],
+        ('Y', 1): [0.2, 0.01],
+        ('Y', 2): [0.1, 0.01],
+    }
+    run('test3', get_test_data2(pp, 10))
+    check_numpy(pp)
+    check_temp_files()
+    check_top_up(
+        run('test3-top-up', get_test_data2(pp, 10), iter=25000, top_up=True),
+        25000)
+    with empty_data():
+        try:
+            run('test3-top-up',
+                get_test_data2(pp, 10),
+                iter=25000,
+                tolerance=0.05,
+                top_up=True)
+            assert False
+        except ValueError:
+            pass
+        assert os.listdir() == [], os.listdir()
+    pp = {
+        ('X', 1): [0.1, 0.02],
+        ('X', 2): [0.1, 0.01],
+        ('Y', 1): [0.1, 0.01],
+        ('Y', 2): [0.1, 0.02],
+    }
+    run('test4-pipeline', get_test_data2(pp, 20), workers=2, pipeline=True)
+    run('test4', get_test_data2(pp, 20))
+    # Before test4-top-up, which adds better results for the same jobs.
+    for pipeline in [False, True]:
+        run('test4-compute',
+            get_test_data2(pp, 20),
+            render=False,
+            pipeline=pipeline)
+        for fn in ['summary.txt', 'freq.txt', 'freq-5.txt']:
+            compare('test4', 'test4-compute', fn)
+        assert sorted(os.listdir('type-ratio-result-test4-compute')) == [
+            'freq-5.txt', 'freq.txt', 'summary.txt', 'timings.json'
+        ]
+    pp2 = {
+        ('X', 1): [0.1, 0.01],
+        ('X', 2): [0.2, 0.01],
+        ('Y', 1): [0.1, 0.01],
+        ('Y', 2): [0.1, 0.01],
+    }
+    check_session([pp, pp2])
+    for fn in ['summary.txt', 'freq.txt', 'freq-5.txt']:
+        compare('test4', 'test4-pipeline', fn)
+    assert sorted(os.listdir('type-ratio-result-test4')) == sorted(
+        os.listdir('type-ratio-result-test4-pipeline'))
+    check_top_up(
+        run('test4-top-up',
+            get_test_data2(pp, 20),
+            iter=20000,
+            top_up=True,
+            pipeline=True), 20000)
 
 
 main()
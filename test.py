@@ -3,7 +3,9 @@
 import itertools
 import math
 import random
+import shutil
 import string
+import struct
 import subprocess
 import sys
 from pathlib import Path
@@ -11,6 +13,7 @@ from pathlib import Path
 DIR = Path('type-ratio-data')
 DIR_IN = DIR / 'in'
 DIR_OUT = DIR / 'out'
+DIR_QUEUE = DIR / 'queue'
 TOOL = Path('build') / 'type-ratio'
 
 
@@ -53,6 +56,19 @@ class Test:
                 enc = ' '.join(map(str, enc))
                 print(f'{enc} -1', file=f)
 
+    def dump_binary(self, f):
+        offsets = [0]
+        indices = []
+        for row in self.data:
+            indices += [self.symmap[0][x] for x in row[0]]
+            indices += [self.symmap[1][x] + self.dim[0] for x in row[1]]
+            offsets.append(len(indices))
+        f.write(
+            struct.pack('<4s5i', b'TRIN', 1, len(self.data), self.dim[0],
+                        self.dim[1], len(indices)))
+        f.write(struct.pack(f'<{len(offsets)}i', *offsets))
+        f.write(struct.pack(f'<{len(indices)}i', *indices))
+
     def exact(self):
         return math.factorial(len(self.data))
 
@@ -75,7 +91,34 @@ class Test:
             self.result.append(row)
         assert len(self.result) == self.xx + 1
 
+    def load_binary(self, f, iter):
+        magic, version, layout, reserved, rows, cols, got_iter, seed = \
+            struct.unpack('<4s3i4q', f.read(48))
+        assert magic == b'TROU'
+        assert version == 1
+        assert rows == self.xx + 1
+        assert cols == self.yy + 1
+        assert got_iter in [0, iter]
+        if layout == 0:
+            values = struct.unpack(f'<{rows * cols}q', f.read(8 * rows * cols))
+            self.result = [
+                list(values[x * cols:(x + 1) * cols]) for x in range(rows)
+            ]
+        else:
+            assert layout == 1
+            first = struct.unpack(f'<{rows}i', f.read(4 * rows))
+            last = struct.unpack(f'<{rows}i', f.read(4 * rows))
+            self.result = []
+            for a, b in zip(first, last):
+                assert 0 <= a <= b <= cols
+                rest = struct.unpack(f'<{b - a}q', f.read(8 * (b - a)))
+                self.result.append([0] * a + list(rest) + [0] * (cols - b))
+        assert f.read() == b''
+
     def verify_exact(self):
+        if len(self.data) > 8:
+            self.verify_subsets()
+            return
         self.expected = [[0 for y in range(self.yy + 1)]
                          for x in range(self.xx + 1)]
         for case in itertools.permutations(self.data):
@@ -87,7 +130,51 @@ class Test:
                 x = len(seen_x)
                 y = len(seen_y)
                 self.expected[x][y] += 1
-        if self.result != self.expected:
+        self.check_expected()
+
+    def classes(self):
+        counts = {}
+        for row in self.data:
+            key = (frozenset(row[0]), frozenset(row[1]))
+            counts[key] = counts.get(key, 0) + 1
+        return list(counts.items())
+
+    def subsets(self):
+        return math.prod(m + 1 for key, m in self.classes())
+
+    def verify_subsets(self):
+        # The first k samples form a given k-subset in k!(n-k)! orders; with
+        # m identical samples, c of them can be chosen in binomial(m, c) ways.
+        n = len(self.data)
+        classes = self.classes()
+        self.expected = [[0 for y in range(self.yy + 1)]
+                         for x in range(self.xx + 1)]
+        for chosen in itertools.product(*(range(m + 1) for key, m in classes)):
+            k = sum(chosen)
+            if k == 0:
+                continue
+            w = math.factorial(k) * math.factorial(n - k)
+            seen_x = set()
+            seen_y = set()
+            for (key, m), c in zip(classes, chosen):
+                w *= math.comb(m, c)
+                if c > 0:
+                    seen_x |= key[0] | key[1]
+                    seen_y |= key[0]
+            self.expected[len(seen_x)][len(seen_y)] += w
+        self.check_expected()
+
+    def check_expected(self):
+        if len(self.data) > 19:
+            # Large exact results are scaled.
+            a = sum(map(sum, self.result))
+            b = sum(map(sum, self.expected))
+            ok = all(r * b == e * a
+                     for rr, ee in zip(self.result, self.expected)
+                     for r, e in zip(rr, ee))
+        else:
+            ok = self.result == self.expected
+        if not ok:
             print('Got:')
             for row in self.result:
                 print(f' {row}')
@@ -162,37 +249,75 @@ class Tests:
     def __init__(self, verbose=False):
         self.tests = []
         self.verbose = verbose
+        self.binary = False
+        self.accumulator = None
+        self.kernel = None
+        self.split = None
+        self.adaptive = None
+        self.seed = None
+        self.queue = None
 
     def add(self, data):
         self.tests.append(Test(data))
 
-    def run_exact(self):
-        self.run(True)
+    def run_exact(self, iter=None):
+        self.run(True, None if iter is None else [iter])
 
     def run_approx(self, iterlist):
         self.run(False, iterlist)
 
     def run(self, run_exact, iterlist=None):
         self.setup()
+        fmt = 'binary' if self.binary else 'text'
+        if self.accumulator:
+            fmt += f', {self.accumulator} accumulator'
+        if self.kernel:
+            fmt += f', {self.kernel} kernel'
+        if self.split:
+            fmt += f', {self.split} streams'
+        if self.adaptive:
+            fmt += f', adaptive {self.adaptive}'
+        if self.seed:
+            fmt += f', seed {self.seed}'
+        if self.queue:
+            fmt += f', queue {self.queue}'
         if run_exact:
-            print('Exact test:')
-            assert iterlist is None
+            print(f'Exact test ({fmt}):')
             iter = 0
         else:
-            print('Approximate test:')
+            print(f'Approximate test ({fmt}):')
             assert iterlist is not None
         for i, test in enumerate(self.tests):
             fn = DIR_IN / f'{i}'
             print(f'· create {fn}')
-            with open(fn, 'w') as f:
-                test.dump(f)
+            if self.binary:
+                with open(fn, 'wb') as f:
+                    test.dump_binary(f)
+            else:
+                with open(fn, 'w') as f:
+                    test.dump(f)
             if run_exact:
                 iter = max(iter, test.exact())
-        if run_exact:
+        if run_exact and iterlist is None:
             iterlist = [iter]
         for iter in iterlist:
-            print(f'· run {TOOL} {iter}')
-            subprocess.run([TOOL, str(iter)], check=True)
+            args = [TOOL, str(iter)]
+            if not self.binary:
+                args.append('--text')
+            if self.accumulator:
+                args.append(f'--accumulator={self.accumulator}')
+            if self.kernel:
+                args.append(f'--kernel={self.kernel}')
+            if self.split:
+                args.append(f'--split={self.split}')
+            if self.adaptive:
+                args.append(f'--adaptive={self.adaptive}')
+            if self.seed:
+                args.append(f'--seed={self.seed}')
+            if self.queue:
+                args.append(f'--queue={self.queue}')
+            print(f'· run {" ".join(map(str, args))}')
+            subprocess.run(args, check=True)
             for i, test in enumerate(self.tests):
                 fn = DIR_OUT / f'{i}'
                 if fn.exists():
@@ -200,16 +325,29 @@ class Tests:
                 else:
                     got_exact = False
                     fn = DIR_OUT / f'{i}.{iter}'
+                    if self.seed:
+                        fn = DIR_OUT / f'{i}.{iter}.s{self.seed}'
+                    if self.adaptive:
+                        # Named by the number of iterations done.
+                        fn, = DIR_OUT.glob(f'{i}.*')
+                        assert iter_done(fn) <= iter
                 print(f'· read {fn}')
-                with open(fn) as f:
-                    test.load(f)
+                if self.binary:
+                    with open(fn, 'rb') as f:
+                        test.load_binary(f, iter_done(fn))
+                else:
+                    with open(fn) as f:
+                        test.load(f)
                 if self.verbose:
                     test.show()
                 if run_exact:
                     assert got_exact
                 test.got_exact = got_exact
         for i, test in enumerate(self.tests):
-            if test.got_exact:
+            if test.got_exact and test.subsets() > 1 << 16:
+                print(f'· verify {i} (exact, approximately)')
+                test.verify_approx(0.1)
+            elif test.got_exact:
                 print(f'· verify {i} (exact)')
                 test.verify_exact()
                 test.verify_approx(0.1)
@@ -225,6 +363,12 @@ class Tests:
             d.mkdir(parents=True, exist_ok=True)
             for f in d.glob('*'):
                 f.unlink()
+        shutil.rmtree(DIR_QUEUE, ignore_errors=True)
+
+
+def iter_done(fn):
+    parts = fn.name.split('.')
+    return int(parts[1]) if len(parts) > 1 else 0
 
 
 def random_subset(x, p):
@@ -257,6 +401,19 @@ def gen_random(a, b, n):
     return data
 
 
+def gen_duplicates(a, b, mult):
+    random.seed(0)
+    asym = pick_symbols(string.ascii_lowercase, a)
+    bsym = pick_symbols(string.ascii_uppercase, b)
+    data = []
+    for m in mult:
+        aa = random_subset(asym, 0.3)
+        bb = random_subset(bsym, 0.3)
+        data += [[aa, bb]] * m
+    random.shuffle(data)
+    return data
+
+
 def main():
     verbose = 'verbose' in sys.argv[1:]
     t = Tests(verbose)
@@ -286,6 +443,99 @@ def main():
         t.add(gen_random(10, 10, n))
         t.add(gen_random(100, 100, n))
     t.run_approx([1000, 2000])
+    t.binary = True
+    t.add([('a', 'A')])
+    t.add([('abc', 'ABCDEF')])
+    t.add([('a', ''), ('', 'A')])
+    for n in range(8):
+        t.add(gen_random(10, 10, n))
+        t.add(gen_random(100, 100, n))
+    t.run_exact()
+    for n in range(100, 1000, 300):
+        t.add(gen_random(10, 10, n))
+        t.add(gen_random(100, 100, n))
+    t.run_approx([1000])
+    for accumulator in ['dense', 'banded']:
+        t.accumulator = accumulator
+        t.add([('a', 'A')])
+        t.add([('a', ''), ('', 'A')])
+        for n in range(8):
+            t.add(gen_random(10, 10, n))
+            t.add(gen_random(100, 100, n))
+        t.run_exact()
+        for n in range(100, 1000, 300):
+            t.add(gen_random(10, 10, n))
+            t.add(gen_random(100, 100, n))
+        t.run_approx([1000])
+    t.accumulator = None
+    for kernel in ['sparse', 'bitset']:
+        t.kernel = kernel
+        t.add([('a', 'A')])
+        t.add([('a', ''), ('', 'A')])
+        for n in range(8):
+            t.add(gen_random(10, 10, n))
+            t.add(gen_random(100, 100, n))
+        for mult in [[37, 2, 1], [30, 3]]:
+            t.add(gen_duplicates(50, 50, mult))
+        t.run_exact(100000)
+        for n in range(100, 1000, 300):
+            t.add(gen_random(10, 10, n))
+            t.add(gen_random(100, 100, n))
+        t.run_approx([1000])
+    t.kernel = None
+    t.split = 4
+    t.add([('a', 'A')])
+    for n in range(8):
+        t.add(gen_random(10, 10, n))
+        t.add(gen_random(100, 100, n))
+    t.run_exact()
+    for n in range(100, 1000, 300):
+        t.add(gen_random(10, 10, n))
+        t.add(gen_random(100, 100, n))
+    t.run_approx([1000, 2001])
+    t.split = None
+    t.adaptive = 0.05
+    for n in range(8):
+        t.add(gen_random(10, 10, n))
+    t.run_exact()
+    for n in range(100, 1000, 300):
+        t.add(gen_random(10, 10, n))
+        t.add(gen_random(100, 100, n))
+    t.run_approx([100000])
+    t.adaptive = None
+    t.seed = 5
+    for n in range(100, 1000, 300):
+        t.add(gen_random(10, 10, n))
+        t.add(gen_random(100, 100, n))
+    t.run_approx([1000])
+    t.seed = None
+    t.queue = None
+    for n in range(9, 15):
+        t.add(gen_random(10, 10, n))
+        t.add(gen_random(25, 25, n))
+    t.run_exact(1000)
+    for n in [18, 20, 22]:
+        t.add(gen_random(10, 10, n))
+        t.add(gen_random(100, 100, n))
+    t.run_exact(100000)
+    for mult in [[2, 2, 2, 2, 2], [5, 1, 1, 1, 1, 1], [9, 5, 3, 1], [20]]:
+        t.add(gen_duplicates(10, 10, mult))
+        t.add(gen_duplicates(25, 25, mult))
+    t.add([('', '')] * 6 + [('a', 'A'), ('b', ''), ('', 'B')])
+    t.run_exact(100)
+    for mult in [[37, 2, 1], [30, 3], [40, 1, 1, 1]]:
+        t.add(gen_duplicates(10, 10, mult))
+        t.add(gen_duplicates(25, 25, mult))
+    t.run_exact(100000)
+    t.queue = 'test'
+    t.add([('a', 'A')])
+    for n in range(8):
+        t.add(gen_random(10, 10, n))
+    t.run_exact()
+    for n in range(100, 1000, 300):
+        t.add(gen_random(10, 10, n))
+        t.add(gen_random(100, 100, n))
+    t.run_approx([1000])
     print('All tests passed.')
 
 
@@ -1,26 +1,106 @@
+import argparse
+import array
+import bisect
 import collections
+import concurrent.futures
+import contextlib
+import csv
+import functools
+import glob
 import hashlib
+import heapq
+import io
+import itertools
+import json
 import logging
+import math
 import os
 import os.path
+import queue
 import re
+import resource
+import sqlite3
+import struct
 import subprocess
-import jinja2
-
-import matplotlib
-
-matplotlib.use('Agg')
-import matplotlib.pyplot as plt
-import matplotlib.colors as mcol
+import sys
+import threading
+import time
+import numpy as np
 
 infty = float('inf')
 
 DIR = 'type-ratio-data'
 DIR_IN = os.path.join(DIR, 'in')
 DIR_OUT = os.path.join(DIR, 'out')
+DIR_QUEUE = os.path.join(DIR, 'queue')
+INDEX = os.path.join(DIR, 'index.sqlite')
 DIR_RESULT = 'type-ratio-result'
 CODE_DIR = os.path.dirname(os.path.abspath(__file__))
 
+# Use exact enumeration if the number of distinct orders of samples is at
+# most EXACT_PREFERENCE times the number of iterations (same rule as the C++
+# tool, which may also sum over subsets of samples instead).
+EXACT_PREFERENCE = 10
+# Up to this many samples, exact results count each of the n! permutations
+# once; for larger inputs, they may be scaled by a constant factor.
+EXACT_UNSCALED_N = 19
+
+# Adaptive mode (same rules as the C++ tool): the size of the first round,
+# and the number of permutations that must fall in the tail at each level
+# before it can be considered converged.
+ADAPTIVE_FIRST_ROUND = 1000
+ADAPTIVE_MIN_TAIL = 10
+
+# Sections of a run specification and their keys, see load_spec. In
+# addition, the section collections has one table for each collection, with
+# the keys in SPEC_COLLECTION.
+SPEC_SECTIONS = {
+    'corpus': ['file', 'format', 'types'],
+    'labels': [
+        'title', 'datasets', 'dataset_labels', 'xlabel', 'ylabel',
+        'timeseries_xlabel'
+    ],
+    'periods': ['list', 'highlight', 'tick_step'],
+    'style': ['shading_fraction', 'yrange', 'trend_yrange', 'trend_step'],
+    'run': [
+        'iter', 'tolerance', 'top_up', 'engine', 'split', 'queue', 'pipeline',
+        'workers'
+    ],
+    'output': ['label', 'dir', 'pdf', 'png', 'freq_top', 'render'],
+}
+SPEC_COLLECTION = ['label', 'color', 'marker_open']
+
+# Stages of Driver.calc that can be run separately; None runs all of them.
+STAGES = [None, 'prepare', 'compute', 'report']
+
+# Buffer size of the frequency reports.
+FREQ_BUFFER = 1 << 20
+
+# Tail fractions marked by print_comparison; adaptive runs check these
+# levels in addition to the shading fractions.
+COMPARISON_LEVELS = [0.1, 0.01, 0.001]
+
+# Binary formats shared with the C++ tool, see src/type-ratio.cc.
+INPUT_MAGIC = b'TRIN'
+OUTPUT_MAGIC = b'TROU'
+FORMAT_VERSION = 1
+# Outputs merged from runs with several seeds; the seed field holds the
+# number of seeds, and the seeds follow the header.
+MERGED_VERSION = 2
+LAYOUT_DENSE = 0
+LAYOUT_BANDED = 1
+DEFAULT_SEED = 1
+OUTPUT_HEADER = np.dtype([
+    ('magic', 'S4'),
+    ('version', '<i4'),
+    ('layout', '<i4'),
+    ('streams', '<i4'),
+    ('rows', '<i8'),
+    ('cols', '<i8'),
+    ('iter', '<i8'),
+    ('seed', '<i8'),
+])
+
 
 def _numrow(l):
     return ' '.join([str(x) for x in l]) + '\n'
@@ -48,12 +128,253 @@ def filter_coll(samplelist, coll):
     return [s for s in samplelist if coll in s.colls]
 
 
+def _is_temp(fn):
+    """Temporary files of atomic writes, possibly left over by an
+    interrupted process."""
+    return re.search(r'\.tmp[0-9]*$', fn) is not None
+
+
+def list_outputs():
+    by_digest = collections.defaultdict(list)
+    os.makedirs(DIR_OUT, exist_ok=True)
+    for fn in os.listdir(DIR_OUT):
+        if _is_temp(fn):
+            continue
+        m = re.fullmatch(r'([0-9a-f]{64})((?:\.[0-9]+(?:\.s[0-9]+)?)?)', fn)
+        assert m is not None, fn
+        by_digest[m.group(1)].append((_output_quality(fn), fn))
+    return by_digest
+
+
+def encode_input(data, dim):
+    n = len(data)
+    m0, m1 = dim
+    offsets = [0]
+    indices = []
+    for row in data:
+        indices.extend(row[0])
+        indices.extend(t + m0 for t in row[1])
+        offsets.append(len(indices))
+    header = struct.pack('<4s5i', INPUT_MAGIC, FORMAT_VERSION, n, m0, m1,
+                         len(indices))
+    return (header + np.array(offsets, dtype='<i4').tobytes() +
+            np.array(indices, dtype='<i4').tobytes())
+
+
+def write_output(filename, accum, iter, seed, text=False):
+    """Writes an output file; seed may also be a list of seeds for a
+    merged binary output."""
+    seeds = seed if isinstance(seed, list) else [seed]
+    assert len(seeds) == 1 or not text
+    nz = accum != 0
+    any_nz = nz.any(axis=1)
+    first = np.where(any_nz, nz.argmax(axis=1), 0)
+    last = np.where(any_nz, accum.shape[1] - nz[:, ::-1].argmax(axis=1), 0)
+    if text:
+        with open(filename, 'w') as f:
+            for row, a, b in zip(accum, first, last):
+                f.write(_numrow([a, b] + row[a:b].tolist()))
+        return
+    rows, cols = accum.shape
+    band = int((last - first).sum())
+    banded = band + rows < rows * cols
+    header = np.zeros((), dtype=OUTPUT_HEADER)
+    header['magic'] = OUTPUT_MAGIC
+    header['version'] = FORMAT_VERSION if len(seeds) == 1 else MERGED_VERSION
+    header['layout'] = LAYOUT_BANDED if banded else LAYOUT_DENSE
+    header['rows'] = rows
+    header['cols'] = cols
+    header['iter'] = iter
+    header['seed'] = seeds[0] if len(seeds) == 1 else len(seeds)
+    with open(filename, 'wb') as f:
+        f.write(header.tobytes())
+        if len(seeds) > 1:
+            f.write(np.array(seeds, dtype='<i8').tobytes())
+        if banded:
+            f.write(first.astype('<i4').tobytes())
+            f.write(last.astype('<i4').tobytes())
+            mask = (np.arange(cols) >= first[:, None]) & (np.arange(cols)
+                                                          < last[:, None])
+            f.write(accum[mask].astype('<i8').tobytes())
+        else:
+            f.write(accum.astype('<i8').tobytes())
+
+
+def read_output_header(filename):
+    """Returns the header of a binary output, or None for text outputs."""
+    with open(filename, 'rb') as f:
+        magic = f.read(len(OUTPUT_MAGIC))
+    if magic != OUTPUT_MAGIC:
+        return None
+    header = np.fromfile(filename, dtype=OUTPUT_HEADER, count=1)[0]
+    assert header['version'] in (FORMAT_VERSION, MERGED_VERSION), filename
+    return header
+
+
+def _output_data_offset(header):
+    offset = OUTPUT_HEADER.itemsize
+    if header['version'] == MERGED_VERSION:
+        offset += 8 * int(header['seed'])
+    return offset
+
+
+def output_seeds(filename):
+    """Returns the list of seeds of a random output, or [] for exact
+    outputs. Text outputs only record a non-default seed in the name."""
+    header = read_output_header(filename)
+    if header is None:
+        fn = os.path.basename(filename)
+        if _output_quality(fn) == infty:
+            return []
+        m = re.search(r'\.s([0-9]+)$', fn)
+        return [int(m.group(1)) if m else DEFAULT_SEED]
+    if not header['iter']:
+        return []
+    if header['version'] == FORMAT_VERSION:
+        return [int(header['seed'])]
+    return np.fromfile(filename,
+                       dtype='<i8',
+                       count=int(header['seed']),
+                       offset=OUTPUT_HEADER.itemsize).tolist()
+
+
+def output_name(digest, iter, seed=DEFAULT_SEED):
+    """Returns the file name of an output; iter is None for exact
+    results."""
+    if iter is None:
+        return digest
+    if seed == DEFAULT_SEED:
+        return f'{digest}.{iter}'
+    return f'{digest}.{iter}.s{seed}'
+
+
+def merge_outputs(digest, fns):
+    """Adds up binary random outputs in DIR_OUT that were calculated with
+    disjoint sets of seeds, and replaces them with one merged output.
+
+    Returns the name of the merged output, or None if the outputs cannot
+    be merged."""
+    headers = [read_output_header(os.path.join(DIR_OUT, fn)) for fn in fns]
+    if any(h is None or not h['iter'] for h in headers):
+        return None
+    seeds = [output_seeds(os.path.join(DIR_OUT, fn)) for fn in fns]
+    all_seeds = sorted(itertools.chain.from_iterable(seeds))
+    if len(set(all_seeds)) != len(all_seeds):
+        return None
+    shape = {(int(h['rows']), int(h['cols'])) for h in headers}
+    if len(shape) != 1:
+        return None
+    rows, cols = shape.pop()
+    iter = sum(int(h['iter']) for h in headers)
+    merged = f'{digest}.{iter}'
+    if merged not in fns and os.path.exists(os.path.join(DIR_OUT, merged)):
+        return None
+    accum = np.zeros((rows, cols), dtype=np.int64)
+    for fn in fns:
+        accum += read_output(os.path.join(DIR_OUT, fn), cols)
+    filename = os.path.join(DIR_OUT, merged)
+    tmp = f'{filename}.tmp{os.getpid()}'
+    write_output(tmp, accum, iter, all_seeds)
+    os.replace(tmp, filename)
+    for fn in fns:
+        if fn != merged:
+            os.unlink(os.path.join(DIR_OUT, fn))
+    logging.debug(f'{merged}: merged {", ".join(fns)}')
+    return merged
+
+
+def read_output(filename, cols):
+    """Returns the accumulator as a rows × cols array of int64.
+
+    Binary outputs with dense layout are memory-mapped."""
+    header = read_output_header(filename)
+    if header is None:
+        return _read_output_text(filename, cols)
+    rows = int(header['rows'])
+    assert header['cols'] == cols, filename
+    offset = _output_data_offset(header)
+    if header['layout'] == LAYOUT_DENSE:
+        return np.memmap(filename,
+                         dtype='<i8',
+                         mode='r',
+                         offset=offset,
+                         shape=(rows, cols))
+    assert header['layout'] == LAYOUT_BANDED, filename
+    ranges = np.memmap(filename,
+                       dtype='<i4',
+                       mode='r',
+                       offset=offset,
+                       shape=(2, rows))
+    first = np.array(ranges[0], dtype=np.int64)
+    last = np.array(ranges[1], dtype=np.int64)
+    assert np.all((0 <= first) & (first <= last) & (last <= cols)), filename
+    width = last - first
+    values = np.memmap(filename,
+                       dtype='<i8',
+                       mode='r',
+                       offset=offset + ranges.nbytes,
+                       shape=(int(width.sum()), ))
+    accum = np.zeros((rows, cols), dtype=np.int64)
+    x = np.repeat(np.arange(rows), width)
+    y = np.arange(len(values)) - np.repeat(np.cumsum(width) - width,
+                                           width) + first[x]
+    accum[x, y] = values
+    return accum
+
+
+def _read_output_text(filename, cols):
+    result = []
+    with open(filename) as f:
+        for line in f:
+            values = [int(v) for v in line.rstrip().split()]
+            first, last = values[:2]
+            rest = values[2:]
+            assert 0 <= first <= last <= cols
+            assert len(rest) == last - first
+            row = [0] * cols
+            row[first:last] = rest
+            result.append(row)
+    return np.array(result, dtype=np.int64).reshape(len(result), cols)
+
+
 def pretty_period(period):
     a, b = period
     return f'{a}–{b-1}'
 
 
+@functools.lru_cache()
+def _matplotlib():
+    """Imports matplotlib with the Agg backend. Matplotlib and jinja2 are
+    only imported when figures or HTML files are rendered, so that runs
+    that do not render anything start faster."""
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.colors
+    import matplotlib.pyplot
+    import matplotlib.ticker
+    return matplotlib
+
+
+@functools.lru_cache()
+def _my_percent_formatter():
+
+    class MyPercentFormatter(_matplotlib().ticker.ScalarFormatter):
+
+        def __call__(self, x, pos=None):
+            f = super().__call__(x, pos)
+            return f + '%'
+
+    return MyPercentFormatter
+
+
+def __getattr__(name):
+    if name == 'MyPercentFormatter':
+        return _my_percent_formatter()
+    raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
+
+
 def lighter(col, w):
+    mcol = _matplotlib().colors
     w = w * 0.7 + 0.3
     rgb = mcol.to_rgb(col)
     h, s, v = mcol.rgb_to_hsv(rgb)
@@ -61,13 +382,6 @@ def lighter(col, w):
     return mcol.hsv_to_rgb([h, s, v])
 
 
-class MyPercentFormatter(matplotlib.ticker.ScalarFormatter):
-
-    def __call__(self, x, pos=None):
-        f = super().__call__(x, pos)
-        return f + '%'
-
-
 class Metadata:
 
     def get_plot_attr(self, coll, light=None):
@@ -84,97 +398,509 @@ class Metadata:
         }
 
 
+class Figure:
+    """Picklable snapshot of a figure: the data series to plot and the
+    output settings, without references to curves or metadata."""
+
+    def __init__(self, dir_result, metadata, rect, formatter, basename=None):
+        self.dir_result = dir_result
+        self.basename = basename
+        self.pdf = metadata.pdf
+        self.png = metadata.png
+        self.rect = rect
+        self.formatter = formatter
+        self.commands = []
+
+    def ax(self, method, *args, **kwargs):
+        self.commands.append((method, args, kwargs))
+
+
+def render_figure(figure):
+    matplotlib = _matplotlib()
+    plt = matplotlib.pyplot
+    fig = plt.figure(figsize=(7, 5))
+    ax = fig.add_axes(figure.rect)
+    if figure.formatter == 'percent':
+        ax.yaxis.set_major_formatter(
+            matplotlib.ticker.PercentFormatter(decimals=0))
+    else:
+        ax.yaxis.set_major_formatter(_my_percent_formatter()())
+    for method, args, kwargs in figure.commands:
+        getattr(ax, method)(*args, **kwargs)
+    os.makedirs(figure.dir_result, exist_ok=True)
+    if figure.pdf:
+        filename = os.path.join(figure.dir_result, f'{figure.basename}.pdf')
+        logging.debug(filename)
+        # No timestamp, so that the output is reproducible.
+        fig.savefig(filename, metadata={'CreationDate': None})
+    if figure.png:
+        filename = os.path.join(figure.dir_result, f'{figure.basename}.png')
+        logging.debug(filename)
+        fig.savefig(filename, dpi=figure.png)
+    plt.close(fig)
+
+
+@functools.lru_cache()
+def _template(name):
+    import jinja2
+    jenv = jinja2.Environment(
+        loader=jinja2.FileSystemLoader(CODE_DIR),
+        autoescape=True,
+    )
+    return jenv.get_template(name)
+
+
+def render_figures(figures, workers=None):
+    """Renders the figures, in a pool of worker processes if workers > 1."""
+    if workers is None or workers <= 1:
+        for figure in figures:
+            render_figure(figure)
+        return
+    with concurrent.futures.ProcessPoolExecutor(workers) as pool:
+        for _ in pool.map(render_figure, figures, chunksize=4):
+            pass
+
+
+class Vocabulary:
+    """Maps types (usually strings) to consecutive integer IDs."""
+
+    def __init__(self):
+        self.ids = {}
+        self.names = []
+        self._ranks = None
+
+    def intern(self, name):
+        id = self.ids.get(name)
+        if id is None:
+            id = len(self.names)
+            self.ids[name] = id
+            self.names.append(name)
+            self._ranks = None
+        return id
+
+    def intern_many(self, names):
+        """Returns a dict that maps each of the names to its ID."""
+        return {name: self.intern(name) for name in set(names)}
+
+    def __getitem__(self, id):
+        return self.names[id]
+
+    def ranks(self):
+        """Returns an array that maps each ID to the rank of its name in
+        sorted order."""
+        if self._ranks is None:
+            order = sorted(range(len(self.names)), key=self.names.__getitem__)
+            self._ranks = np.empty(len(order), dtype=np.int64)
+            self._ranks[order] = np.arange(len(order))
+        return self._ranks
+
+
+class TypeDict:
+    """On-disk vocabulary, for vocabularies too large to keep in memory.
+
+    Use set_vocabulary(TypeDict(filename)) before creating samples, and
+    close() it (or call commit()) before other processes read the file.
+    New types added one at a time with intern() are committed in batches
+    of commit_size.
+    """
+
+    def __init__(self, filename, cache_size=1 << 16, commit_size=1 << 14):
+        self.db = sqlite3.connect(filename)
+        self.db.execute('''
+            CREATE TABLE IF NOT EXISTS types (
+                id INTEGER PRIMARY KEY,
+                name TEXT UNIQUE NOT NULL
+            )''')
+        self.lookup = functools.lru_cache(cache_size)(self._lookup)
+        self.intern = functools.lru_cache(cache_size)(self._intern)
+        self._ranks = None
+        self.commit_size = commit_size
+        self._uncommitted = 0
+
+    def _intern(self, name):
+        cur = self.db.execute('INSERT OR IGNORE INTO types (name) VALUES (?)',
+                              (name, ))
+        if cur.rowcount:
+            self._ranks = None
+            self._uncommitted += 1
+            if self._uncommitted >= self.commit_size:
+                self.commit()
+            return cur.lastrowid
+        return self.db.execute('SELECT id FROM types WHERE name = ?',
+                               (name, )).fetchone()[0]
+
+    def commit(self):
+        self.db.commit()
+        self._uncommitted = 0
+
+    def intern_many(self, names):
+        """Returns a dict that maps each of the names to its ID."""
+        names = list(set(names))
+        cur = self.db.executemany(
+            'INSERT OR IGNORE INTO types (name) VALUES (?)',
+            [(name, ) for name in names])
+        if cur.rowcount:
+            self._ranks = None
+        self.commit()
+        ids = {}
+        for i in range(0, len(names), 500):
+            part = names[i:i + 500]
+            q = ','.join('?' * len(part))
+            ids.update((name, id) for id, name in self.db.execute(
+                f'SELECT id, name FROM types WHERE name IN ({q})', part))
+        return ids
+
+    def _lookup(self, id):
+        row = self.db.execute('SELECT name FROM types WHERE id = ?',
+                              (id, )).fetchone()
+        if row is None:
+            raise KeyError(id)
+        return row[0]
+
+    def __getitem__(self, id):
+        return self.lookup(id)
+
+    def ranks(self):
+        self.commit()
+        if self._ranks is None:
+            order = np.array([
+                row[0]
+                for row in self.db.execute('SELECT id FROM types ORDER BY name')
+            ],
+                             dtype=np.int64)
+            size = int(order.max()) + 1 if len(order) else 0
+            self._ranks = np.zeros(size, dtype=np.int64)
+            self._ranks[order] = np.arange(len(order))
+        return self._ranks
+
+    def close(self):
+        self.commit()
+        self.db.close()
+
+
+vocabulary = Vocabulary()
+
+
+def set_vocabulary(v):
+    """Sets the global vocabulary; must be called before creating samples."""
+    global vocabulary
+    vocabulary = v
+
+
 class Sample:
+    """A sample; for each dataset, stores the IDs of the distinct types in
+    increasing order, and the number of tokens of each type."""
+
+    __slots__ = ['label', 'periods', 'colls', 'types', 'counts']
 
     def __init__(self, label, periods, colls):
         self.label = label
         self.periods = set(periods)
         self.colls = set(colls)
-        self.tokens = [set(), set()]
-        self.tokenlists = [[], []]
+        self.types = [array.array('i'), array.array('i')]
+        self.counts = [array.array('i'), array.array('i')]
 
     def feed(self, dataset, token):
-        self.tokens[dataset].add(token)
-        self.tokenlists[dataset].append(token)
+        self.feed_id(dataset, vocabulary.intern(token))
 
-
-class Point:
+    def feed_id(self, dataset, t, count=1):
+        types = self.types[dataset]
+        i = bisect.bisect_left(types, t)
+        if i < len(types) and types[i] == t:
+            self.counts[dataset][i] += count
+        else:
+            types.insert(i, t)
+            self.counts[dataset].insert(i, count)
+
+
+def _parse_period(s):
+    a, b = s.split('-')
+    return int(a), int(b)
+
+
+def _split_list(s):
+    return [x for x in s.split(',') if x]
+
+
+def read_samples(filename, format=None, datasets=None, chunk_size=1 << 16):
+    """Builds samples from a token table with one row per token occurrence.
+
+    In TSV format (the default, optionally with a header line), the
+    columns are: sample label, periods, collections, dataset, type.
+    Periods are given as start-end (end exclusive) and both periods and
+    collections are comma-separated. In JSONL format (used if format is
+    'jsonl' or the file name ends with .jsonl), each line is an object
+    with keys sample, periods (a list of [start, end] pairs), colls,
+    dataset and type. The dataset is 0 or 1, or one of the names in
+    datasets.
+
+    The file is processed in chunks of chunk_size rows, and the types of
+    each chunk are added to the global vocabulary at once.
+    """
+    if format is None:
+        format = 'jsonl' if filename.endswith('.jsonl') else 'tsv'
+    dataset_ids = {'0': 0, '1': 1, 0: 0, 1: 1}
+    if datasets is not None:
+        for i, d in enumerate(datasets):
+            dataset_ids[d] = i
+    samples = {}
+    with open(filename, newline='') as f:
+        if format == 'jsonl':
+            rows = (_jsonl_row(line) for line in f if line.strip())
+            parse_periods = lambda x: [tuple(p) for p in x]
+            parse_colls = list
+        else:
+            assert format == 'tsv', format
+            rows = _tsv_rows(f)
+            parse_periods = lambda x: [
+                _parse_period(p) for p in _split_list(x)
+            ]
+            parse_colls = _split_list
+        while True:
+            chunk = list(itertools.islice(rows, chunk_size))
+            if not chunk:
+                break
+            ids = vocabulary.intern_many(row[4] for row in chunk)
+            for label, periods, colls, dataset, t in chunk:
+                s = samples.get(label)
+                if s is None:
+                    s = Sample(label, parse_periods(periods),
+                               parse_colls(colls))
+                    samples[label] = s
+                s.feed_id(dataset_ids[dataset], ids[t])
+    return list(samples.values())
+
+
+def _tsv_rows(f):
+    reader = csv.reader(f, delimiter='\t', quoting=csv.QUOTE_NONE)
+    for i, row in enumerate(reader):
+        if i == 0 and row[0] == 'sample':
+            continue
+        yield row
+
+
+def _jsonl_row(line):
+    d = json.loads(line)
+    return d['sample'], d['periods'], d['colls'], d['dataset'], d['type']
+
+
+class Incidence:
+    """Sample × type incidence matrix of a list of samples, with period and
+    collection membership masks.
+
+    For each dataset, the matrix is stored in CSR form: the entries of
+    sample j are entries indptr[j]..indptr[j+1]-1, with type IDs in
+    types and token counts in counts. Types are also numbered locally
+    0..L-1 (in the order of their IDs) so that aggregates over any subset
+    of samples can be computed with bincount.
+    """
 
     def __init__(self, samplelist):
         self.samplelist = samplelist
-        self.tokens = [set(), set()]
-        self.tokencounts = [collections.Counter(), collections.Counter()]
-        self.samplecounts = [collections.Counter(), collections.Counter()]
-        for s in samplelist:
-            for i in range(2):
-                self.tokens[i] |= s.tokens[i]
-                self.tokencounts[i].update(s.tokenlists[i])
-                for t in s.tokens[i]:
-                    self.samplecounts[i][t] += 1
-        self.dim = [len(x) for x in self.tokens]
+        n = len(samplelist)
+        self.indptr = []
+        self.rows = []
+        self.types = []
+        self.local = []
+        self.type_ids = []
+        self.counts = []
+        for i in range(2):
+            lengths = np.fromiter((len(s.types[i]) for s in samplelist),
+                                  dtype=np.int64,
+                                  count=n)
+            indptr = np.zeros(n + 1, dtype=np.int64)
+            np.cumsum(lengths, out=indptr[1:])
+            types = np.concatenate([np.zeros(0, dtype=np.intc)] + [
+                np.frombuffer(s.types[i], dtype=np.intc) for s in samplelist
+            ]).astype(np.int64)
+            counts = np.concatenate([np.zeros(0, dtype=np.intc)] + [
+                np.frombuffer(s.counts[i], dtype=np.intc) for s in samplelist
+            ]).astype(np.int64)
+            type_ids, local = np.unique(types, return_inverse=True)
+            self.indptr.append(indptr)
+            self.rows.append(np.repeat(np.arange(n), lengths))
+            self.types.append(types)
+            self.local.append(local.reshape(-1))
+            self.type_ids.append(type_ids)
+            self.counts.append(counts)
+        period_rows = collections.defaultdict(list)
+        coll_rows = collections.defaultdict(list)
+        for j, s in enumerate(samplelist):
+            for period in s.periods:
+                period_rows[period].append(j)
+            for coll in s.colls:
+                coll_rows[coll].append(j)
+        self.period_masks = {
+            k: self._mask(v)
+            for k, v in period_rows.items()
+        }
+        self.coll_masks = {k: self._mask(v) for k, v in coll_rows.items()}
+
+    def _mask(self, rows):
+        mask = np.zeros(len(self.samplelist), dtype=bool)
+        mask[rows] = True
+        return mask
+
+    def all(self):
+        return np.ones(len(self.samplelist), dtype=bool)
+
+    def period_mask(self, period):
+        return self.period_masks.get(period, ~self.all())
+
+    def coll_mask(self, coll):
+        return self.coll_masks.get(coll, ~self.all())
+
+    def select(self, mask):
+        return [self.samplelist[j] for j in np.flatnonzero(mask)]
+
+    def aggregate(self, mask, i):
+        """Returns the type IDs that occur in the selected samples in
+        dataset i, with their token counts and sample counts."""
+        sel = mask[self.rows[i]]
+        local = self.local[i][sel]
+        size = len(self.type_ids[i])
+        samplecounts = np.bincount(local, minlength=size)
+        tokencounts = np.bincount(local,
+                                  weights=self.counts[i][sel],
+                                  minlength=size)
+        present = np.flatnonzero(samplecounts)
+        return (self.type_ids[i][present],
+                tokencounts[present].astype(np.int64), samplecounts[present])
+
+    def encode(self, mask, i, positions):
+        """Returns, for each selected sample, the sorted list of
+        positions[t] for the types t of the sample in dataset i."""
+        sel = mask[self.rows[i]]
+        rows = self.rows[i][sel]
+        pos = positions[self.local[i][sel]]
+        order = np.lexsort((pos, rows))
+        lengths = np.diff(self.indptr[i])[mask]
+        return [
+            part.tolist()
+            for part in np.split(pos[order],
+                                 np.cumsum(lengths)[:-1])
+        ] if len(lengths) else []
+
+
+class Point:
+    """Aggregate statistics of a set of samples.
+
+    For each dataset i, types[i] contains the IDs of the types that occur
+    in the samples, in increasing order, and tokencounts[i] and
+    samplecounts[i] contain the corresponding numbers of tokens and
+    samples. The samples can be given as a list, or as a mask over the
+    samples of an Incidence.
+    """
+
+    def __init__(self, samplelist, incidence=None, mask=None):
+        if incidence is None:
+            incidence = Incidence(samplelist)
+            mask = incidence.all()
+        elif samplelist is None:
+            samplelist = incidence.select(mask)
+        self.samplelist = samplelist
+        self.incidence = incidence
+        self.mask = mask
+        self.types = []
+        self.tokencounts = []
+        self.samplecounts = []
+        for i in range(2):
+            types, tokencounts, samplecounts = incidence.aggregate(mask, i)
+            self.types.append(types)
+            self.tokencounts.append(tokencounts)
+            self.samplecounts.append(samplecounts)
+        self.dim = [len(x) for x in self.types]
         self.xx = sum(self.dim)
         self.yy = self.dim[0]
 
 
 class Curve(Point):
 
-    def __init__(self, metadata, period, samplelist):
-        super().__init__(samplelist)
+    def __init__(self,
+                 metadata,
+                 period,
+                 samplelist,
+                 incidence=None,
+                 mask=None):
+        super().__init__(samplelist, incidence, mask)
         self.metadata = metadata
         self.period = period
         if period is not None:
             self.pperiod = pretty_period(period)
             self.is_major = metadata.tick_hook(period)
 
-    def calc_write_input(self):
-        self.sorted_tokens = [sorted(tt) for tt in self.tokens]
-        self.tokenmaps = [{t: i
-                           for i, t in enumerate(tt)}
-                          for tt in self.sorted_tokens]
-        data = []
-        for s in self.samplelist:
-            row = []
-            for di in range(2):
-                part = [self.tokenmaps[di][t] for t in s.tokens[di]]
-                part.sort()
-                row.append(part)
-            data.append(row)
+    def calc_input(self, text=False):
+        """Computes the engine input and its digest without writing it."""
+        # Types are numbered in the order of their names, so that the
+        # digest does not depend on the order in which IDs were assigned.
+        ranks = vocabulary.ranks()
+        inc = self.incidence
+        parts = []
+        for i in range(2):
+            order = np.argsort(ranks[self.types[i]], kind='stable')
+            positions = np.zeros(len(inc.type_ids[i]), dtype=np.int64)
+            present = np.searchsorted(inc.type_ids[i], self.types[i])
+            positions[present[order]] = np.arange(len(order))
+            parts.append(inc.encode(self.mask, i, positions))
+        data = [list(row) for row in zip(*parts)]
         data.sort()
-        sdata = ''
-        sdata += _numrow([len(data)] + self.dim)
-        for row in data:
-            sdata += _numrow(row[0] + [-1] + row[1] + [-1])
-        sdata = bytes(sdata, encoding='ascii')
-        self.digest = hashlib.sha256(sdata).hexdigest()
+        self.data = data
+        # The digest is always computed from the text encoding so that
+        # results can be reused regardless of the file format.
+        h = hashlib.sha256()
+        buf = io.BytesIO() if text else None
+        for row in itertools.chain([[len(data)] + self.dim],
+                                   (r[0] + [-1] + r[1] + [-1] for r in data)):
+            line = _numrow(row).encode('ascii')
+            h.update(line)
+            if text:
+                buf.write(line)
+        self.digest = h.hexdigest()
+        self.input_data = buf.getvalue() if text else encode_input(
+            data, self.dim)
+        self.input_size = len(self.input_data)
+
+    def write_input(self):
+        """Writes the input unless a file with the same digest exists."""
         os.makedirs(DIR_IN, exist_ok=True)
         filename = os.path.join(DIR_IN, self.digest)
+        if os.path.exists(filename):
+            return
         logging.debug(filename)
-        with open(filename, 'wb') as f:
-            f.write(sdata)
+        tmp = f'{filename}.tmp{os.getpid()}'
+        with open(tmp, 'wb') as f:
+            f.write(self.input_data)
+        os.replace(tmp, filename)
+
+    def calc_write_input(self, text=False):
+        self.calc_input(text)
+        self.write_input()
 
     def calc_read_output(self, best):
         filename = os.path.join(DIR_OUT, best[self.digest])
         logging.debug(filename)
-        self.cum = []
-        with open(filename) as f:
-            for line in f:
-                values = [int(v) for v in line.rstrip().split()]
-                first, last = values[:2]
-                rest = values[2:]
-                assert 0 <= first <= last <= self.yy + 1
-                assert len(rest) == last - first
-                s = 0
-                cum = [0]
-                for i in range(first):
-                    cum.append(s)
-                for v in rest:
-                    s += v
-                    cum.append(s)
-                for i in range(last, self.yy + 1):
-                    cum.append(s)
-                assert len(cum) == self.yy + 2
-                self.cum.append(cum)
-        assert len(self.cum) == self.xx + 1
+        accum = read_output(filename, self.yy + 1)
+        assert accum.shape == (self.xx + 1, self.yy + 1)
+        self.set_output(accum)
+
+    def set_output(self, accum):
+        """Stores the cumulative table and the first moments of each row."""
+        self.cum = np.zeros((self.xx + 1, self.yy + 2), dtype=np.int64)
+        np.cumsum(accum, axis=1, out=self.cum[:, 1:])
+        self.tot = self.cum[:, -1]
+        weights = np.arange(self.yy + 1)
+        if int(self.tot.max(initial=0)) * max(self.yy, 1) < 1 << 62:
+            self.moments = accum @ weights
+        else:
+            # Too large for int64; use exact integers.
+            self.moments = np.array(
+                [sum(int(v) * y for y, v in enumerate(row)) for row in accum],
+                dtype=object)
+
+    def share_output(self, other):
+        self.cum = other.cum
+        self.tot = other.tot
+        self.moments = other.moments
 
     def get_med_pct(self, xx):
         if xx > self.xx:
@@ -185,7 +911,7 @@ class Curve(Point):
     def get_mean_pct(self, xx):
         if xx > self.xx:
             return None
-        elif self.cum[xx][-1] == 0:
+        elif self.tot[xx] == 0:
             # FIXME
             return None
         else:
@@ -207,52 +933,91 @@ class Curve(Point):
         return (a + b) / 2
 
     def get_mean(self, xx):
-        row = self.cum[xx]
-        tot = row[-1]
-        s = 0
-        for yy in range(self.yy + 1):
-            d = row[yy + 1] - row[yy]
-            s += yy * d
-        return s / tot
+        return int(self.moments[xx]) / int(self.tot[xx])
 
     def get_up(self, xx, level):
-        row = self.cum[xx]
-        tot = row[-1]
-        exp = tot * (1.0 - level)
-        yy = self.yy
-        while yy > 0 and row[yy] >= exp:
-            yy -= 1
-        return yy
+        return int(self.quantiles([xx], level)[1][0])
 
     def get_low(self, xx, level):
-        row = self.cum[xx]
-        tot = row[-1]
-        exp = tot * level
-        yy = 0
-        while yy + 1 < len(row) and row[yy + 1] <= exp:
-            yy += 1
-        return yy
+        return int(self.quantiles([xx], level)[0][0])
+
+    def means(self, xx):
+        """Returns the mean y for each x in the array xx."""
+        xx = np.asarray(xx, dtype=np.int64)
+        return self.moments[xx] / self.tot[xx]
+
+    def quantiles(self, xx, level):
+        """Returns arrays (low, up) of the lower and upper level-quantiles
+        of y for each x in the array xx, using binary search."""
+        xx = np.asarray(xx, dtype=np.int64)
+        tot = self.tot[xx]
+        # Largest y with cum[y+1] <= tot * level.
+        low = _search_rows(self.cum, xx, self.yy + 1, tot * level, 'right')
+        # Smallest y >= 0 such that cum[y'] >= tot * (1 - level) for all
+        # y' in y+1..yy.
+        up = _search_rows(self.cum, xx, self.yy, tot * (1.0 - level), 'left')
+        return low, up
+
+    def quantile_pcts(self, xx, level):
+        """Vectorized get_low_pct and get_up_pct."""
+        xx = np.asarray(xx, dtype=np.int64)
+        low, up = self.quantiles(xx, level)
+        nonzero = xx != 0
+        div = np.where(nonzero, xx, 1)
+        low = np.where(nonzero, low / div * 100, 0)
+        up = np.where(nonzero, up / div * 100, 100)
+        return low, up
+
+
+def _search_rows(cum, xx, m, values, side):
+    """Row-wise np.searchsorted: for each x in xx, the number of elements
+    among cum[x, 1:m+1] that are < value (side='left') or <= value
+    (side='right')."""
+    lo = np.zeros(len(xx), dtype=np.int64)
+    hi = np.full(len(xx), m, dtype=np.int64)
+    while True:
+        active = lo < hi
+        if not active.any():
+            return lo
+        mid = (lo + hi) // 2
+        v = cum[xx, 1 + np.minimum(mid, m - 1)]
+        if side == 'left':
+            right = v < values
+        else:
+            right = v <= values
+        lo = np.where(active & right, mid + 1, lo)
+        hi = np.where(active & ~right, mid, hi)
 
 
 class MultiCurve(Curve):
 
-    def __init__(self, metadata, period, colls, samplelist, overall=None):
-        super().__init__(metadata, period, samplelist)
+    def __init__(self,
+                 metadata,
+                 period,
+                 colls,
+                 samplelist,
+                 overall=None,
+                 incidence=None,
+                 mask=None):
+        super().__init__(metadata, period, samplelist, incidence, mask)
         self.overall = overall
         self.colls = colls
         self.points = {}
         self.pointlist = []
         for coll in colls:
-            sl = filter_coll(samplelist, coll)
-            point = Curve(metadata, period, sl)
+            point = Curve(metadata, period, None, self.incidence,
+                          self.mask & self.incidence.coll_mask(coll))
             point.coll = coll
             self.points[coll] = point
             self.pointlist.append(point)
 
-    def calc_write_input_all(self):
-        self.calc_write_input()
+    def calc_write_input_all(self, text=False):
+        self.calc_write_input(text)
         for point in self.pointlist:
-            point.calc_write_input()
+            point.calc_write_input(text)
+
+    def get_curves(self):
+        return [self] + self.pointlist
 
     def calc_read_output_all(self, best):
         self.calc_read_output(best)
@@ -320,20 +1085,44 @@ class MultiCurve(Curve):
         print(m, file=f)
 
     def print_point_freq(self, point, f, top):
-        print(
-            f'{self.pperiod}, {point.coll} = {self.metadata.coll_labels[point.coll]}:',
-            file=f)
-        print(file=f)
+        self.print_point_freqs(point, {top: f})
+
+    def print_point_freqs(self, point, files):
+        """Writes the types of the point, most frequent first, to each file
+        in files: the full listing to files[None] and the top k types to
+        files[k]. Each dataset is sorted only once."""
+        head = f'{self.pperiod}, {point.coll} = {self.metadata.coll_labels[point.coll]}:\n\n'
+        for f in files.values():
+            f.write(head)
+        tops = [top for top in files if top is not None]
+        name = vocabulary.__getitem__
+        key = lambda x: (-x[0], name(x[2]))
         for i in range(2):
-            print(f'   {self.metadata.dataset_labels[i]}:', file=f)
-            l = sorted(point.tokencounts[i].most_common(),
-                       key=lambda x: (-x[1], x[0]))
-            if top is not None:
-                l = l[:top]
-            for w, c in l:
-                sc = point.samplecounts[i][w]
-                print(f'    {c:8d} tokens {sc:4d} samples:  {w}', file=f)
-        print(file=f)
+            for f in files.values():
+                f.write(f'   {self.metadata.dataset_labels[i]}:\n')
+            counts = point.tokencounts[i]
+            rows = zip(counts.tolist(), point.samplecounts[i].tolist(),
+                       point.types[i].tolist())
+            if None in files:
+                l = sorted(rows, key=key)
+            elif tops:
+                # Only types with at least as many tokens as the k-th most
+                # frequent type can make it to the top k.
+                k = max(tops)
+                if k < len(counts):
+                    threshold = np.partition(counts, -k)[-k]
+                    rows = itertools.compress(rows, counts >= threshold)
+                l = heapq.nsmallest(k, rows, key=key)
+            else:
+                l = []
+            lines = [
+                f'    {c:8d} tokens {sc:4d} samples:  {name(w)}\n'
+                for c, sc, w in l
+            ]
+            for top, f in files.items():
+                f.write(''.join(lines[:top]))
+        for f in files.values():
+            f.write('\n')
 
     def print_summary(self, f):
         print(f' {self.pperiod}:', file=f)
@@ -360,28 +1149,33 @@ class MultiCurve(Curve):
         print(file=f)
 
     def print_freq(self, f, top):
+        self.print_freqs({top: f})
+
+    def print_freqs(self, files):
         for point in self.pointlist:
-            self.print_point_freq(point, f, top)
+            self.print_point_freqs(point, files)
 
     def plot(self, dir_result, other=None):
-        fig = plt.figure(figsize=(7, 5))
-        ax = fig.add_axes([0.12, 0.125, 0.85, 0.86])
-        ax.set_ylim(self.metadata.yrange)
-        ax.set_xlabel(self.metadata.xlabel, labelpad=15)
-        ax.set_ylabel(self.metadata.ylabel, labelpad=8)
-        ax.yaxis.set_major_formatter(
-            matplotlib.ticker.PercentFormatter(decimals=0))
+        render_figure(self.figure(dir_result, other))
+
+    def figure(self, dir_result, other=None):
+        fig = Figure(dir_result, self.metadata, [0.12, 0.125, 0.85, 0.86],
+                     'percent')
+        fig.ax('set_ylim', self.metadata.yrange)
+        fig.ax('set_xlabel', self.metadata.xlabel, labelpad=15)
+        fig.ax('set_ylabel', self.metadata.ylabel, labelpad=8)
 
         xxx = list(range(1, self.xx + 1))
         for f in self.metadata.shading_fraction:
-            up = [self.get_up_pct(xx, f) for xx in xxx]
-            low = [self.get_low_pct(xx, f) for xx in xxx]
-            ax.fill_between(xxx,
-                            up,
-                            low,
-                            color='#000000',
-                            alpha=0.1,
-                            linewidth=0)
+            low, up = self.quantile_pcts(xxx, f)
+            low, up = low.tolist(), up.tolist()
+            fig.ax('fill_between',
+                   xxx,
+                   up,
+                   low,
+                   color='#000000',
+                   alpha=0.1,
+                   linewidth=0)
 
         def plot_point(coll, point):
             if point.xx == 0:
@@ -396,11 +1190,11 @@ class MultiCurve(Curve):
             else:
                 color = '#000000'
                 attr = dict(color=color, marker='o')
-            ax.plot([point.xx, point.xx], [up, low],
-                    color=color,
-                    linewidth=2,
-                    ls=':')
-            ax.plot(point.xx, pct, **attr)
+            fig.ax('plot', [point.xx, point.xx], [up, low],
+                   color=color,
+                   linewidth=2,
+                   ls=':')
+            fig.ax('plot', point.xx, pct, **attr)
 
         if other is None:
             for coll in self.colls:
@@ -408,22 +1202,13 @@ class MultiCurve(Curve):
         else:
             plot_point(None, other)
         if self.period is not None:
-            basename = f'period-{self.period[0]}-{self.period[1]-1}'
+            fig.basename = f'period-{self.period[0]}-{self.period[1]-1}'
         elif other is not None:
             assert other.period is not None
-            basename = f'period-all-{other.period[0]}-{other.period[1]-1}'
+            fig.basename = f'period-all-{other.period[0]}-{other.period[1]-1}'
         else:
-            basename = f'period-all'
-        os.makedirs(dir_result, exist_ok=True)
-        if self.metadata.pdf:
-            filename = os.path.join(dir_result, f'{basename}.pdf')
-            logging.debug(filename)
-            fig.savefig(filename)
-        if self.metadata.png:
-            filename = os.path.join(dir_result, f'{basename}.png')
-            logging.debug(filename)
-            fig.savefig(filename, dpi=self.metadata.png)
-        plt.close(fig)
+            fig.basename = f'period-all'
+        return fig
 
 
 class TimeSeries:
@@ -432,16 +1217,24 @@ class TimeSeries:
         self.metadata = metadata
         self.colls = colls
         self.samplelist = samplelist
-        self.overall = MultiCurve(metadata, None, colls, samplelist)
+        self.incidence = Incidence(samplelist)
+        self._token_matrix = None
+        self.overall = MultiCurve(metadata,
+                                  None,
+                                  colls,
+                                  samplelist,
+                                  incidence=self.incidence,
+                                  mask=self.incidence.all())
         self.curves = {}
         self.curvelist = []
         for period in metadata.periods:
-            sl = filter_period(samplelist, period)
             curve = MultiCurve(metadata,
                                period,
                                colls,
-                               sl,
-                               overall=self.overall)
+                               None,
+                               overall=self.overall,
+                               incidence=self.incidence,
+                               mask=self.incidence.period_mask(period))
             self.curves[period] = curve
             self.curvelist.append(curve)
 
@@ -453,88 +1246,75 @@ class TimeSeries:
         self.overall.print_overall(f)
 
     def print_freq(self, f, top):
-        print(self.metadata.title, file=f)
-        print(file=f)
+        self.print_freqs({top: f})
+
+    def print_freqs(self, files):
+        """Writes the frequency reports of all periods in a single pass,
+        see MultiCurve.print_point_freqs."""
+        for f in files.values():
+            f.write(f'{self.metadata.title}\n\n')
         for curve in self.curvelist:
-            curve.print_freq(f, top)
+            curve.print_freqs(files)
 
     def illustrate_freq(self, dir_result):
         self.illustrate_freq_coll(dir_result, None)
         for coll in self.colls:
             self.illustrate_freq_coll(dir_result, coll)
 
+    def token_matrix(self):
+        """Returns (type_ids, counts): counts[k, i, r, j] is the number of
+        tokens of type type_ids[r] in dataset i and period j, in all
+        collections if k = 0 and in collection colls[k-1] otherwise.
+        Computed once and shared by all collections."""
+        if self._token_matrix is None:
+            inc = self.incidence
+            type_ids = np.union1d(inc.type_ids[0], inc.type_ids[1])
+            counts = np.zeros(
+                (len(self.colls) + 1, 2, len(type_ids), len(self.curvelist)),
+                dtype=np.int64)
+            for j, curve in enumerate(self.curvelist):
+                points = [curve] + [curve.points[c] for c in self.colls]
+                for k, p in enumerate(points):
+                    for i in range(2):
+                        rows = np.searchsorted(type_ids, p.types[i])
+                        counts[k, i, rows, j] = p.tokencounts[i]
+            self._token_matrix = type_ids, counts
+        return self._token_matrix
+
     def illustrate_freq_coll(self, dir_result, coll):
         scale = 1000
         limit_pct = 1
         limit_freq = 2
         minperiods = 2
 
-        col_totals = [collections.Counter(), collections.Counter()]
-        token_totals = [collections.Counter(), collections.Counter()]
-        token_counts = [collections.Counter(), collections.Counter()]
-        overall = [0, 0]
-        columns = []
-        for curve in self.curvelist:
-            col = curve.period
-            columns.append({
-                'id': col,
-                'label': curve.period[0],
-                'label2': curve.period[1] - 1
-            })
-            if coll:
-                p = curve.points[coll]
-            else:
-                p = curve
-            for i in range(2):
-                for t, count in p.tokencounts[i].items():
-                    token_counts[i][(t, col)] += count
-                    token_totals[i][t] += count
-                    col_totals[i][col] += count
-                    overall[i] += count
-
-        col_totals_s = col_totals[0] + col_totals[1]
-        token_totals_s = token_totals[0] + token_totals[1]
-        token_counts_s = token_counts[0] + token_counts[1]
-
-        tokens = list(token_totals_s.keys())
-        relevant_tokens = collections.Counter()
-        tot_pct = collections.Counter()
-
-        for curve in self.curvelist:
-            col = curve.period
-            s = col_totals_s[col]
-            for t in tokens:
-                x = token_counts_s[(t, col)]
-                if x:
-                    tot_pct[t] += x / s
-                    if x / s >= limit_pct / 100 and x >= limit_freq:
-                        relevant_tokens[t] += 1
-
-        tokens = [t for t in tokens if relevant_tokens[t] >= minperiods]
-        tokens.sort()
-        tokens.sort(key=lambda x: tot_pct[x], reverse=True)
-
-        heights1 = [{}, {}]
-        heights2 = [{}, {}]
-        heights3 = [{}, {}]
-        for i in range(2):
-            for curve in self.curvelist:
-                col = curve.period
-                s = col_totals_s[col]
-                if s == 0:
-                    continue
-                for t in tokens:
-                    x = token_counts[i][(t, col)]
-                    f1 = max((x - 1) / s, 0)
-                    f2 = x / s
-                    f3 = (x + 1) / s
-                    f1 = round(f1 * scale)
-                    f2 = round(f2 * scale)
-                    f3 = round(f3 * scale)
-                    heights1[i][(t, col)] = f1
-                    heights2[i][(t, col)] = f2 - f1
-                    heights3[i][(t, col)] = f3 - f2
-
+        type_ids, counts = self.token_matrix()
+        k = 0 if coll is None else self.colls.index(coll) + 1
+        counts = counts[k]
+        counts_s = counts[0] + counts[1]
+        col_totals_s = counts_s.sum(axis=0)
+
+        relevant = np.zeros(len(type_ids), dtype=np.int64)
+        tot_pct = np.zeros(len(type_ids))
+        for j, s in enumerate(col_totals_s.tolist()):
+            if s == 0:
+                continue
+            x = counts_s[:, j]
+            tot_pct += x / s
+            relevant += (x / s >= limit_pct / 100) & (x >= limit_freq)
+
+        rows = np.flatnonzero(relevant >= minperiods).tolist()
+        names = {r: vocabulary[int(type_ids[r])] for r in rows}
+        rows.sort(key=lambda x: names[x])
+        rows.sort(key=lambda x: tot_pct[x], reverse=True)
+
+        counts = counts[:, rows, :]
+        s = np.where(col_totals_s > 0, col_totals_s, 1)
+        f1 = np.round(np.maximum((counts - 1) / s, 0) * scale)
+        f2 = np.round(counts / s * scale)
+        f1[:, :, col_totals_s == 0] = 0
+        f2[:, :, col_totals_s == 0] = 0
+
+        columns = [[c.period[0], c.period[1] - 1] for c in self.curvelist]
         title = self.metadata.title
         subtitle = None
         if coll:
@@ -547,79 +1327,92 @@ class TimeSeries:
             'subtitle': subtitle,
             'notes': notes,
             'datasets': self.metadata.datasets,
-            'tokens': tokens,
             'columns': columns,
-            'counts': token_counts,
-            'heights1': heights1,
-            'heights2': heights2,
-            'heights3': heights3,
+            'tokens': [names[r] for r in rows],
+            'counts': counts.tolist(),
+            'heights1': f1.astype(np.int64).tolist(),
+            'heights2': (f2 - f1).astype(np.int64).tolist(),
         }
 
         basename = 'tokens'
         if coll:
             basename += '-' + coll
-        filename = os.path.join(dir_result, f'{basename}.html')
-        jenv = jinja2.Environment(
-            loader=jinja2.FileSystemLoader(CODE_DIR),
-            autoescape=True,
-        )
-        jtempl = jenv.get_template('templates/tokens.html')
-        with open(filename, 'w') as f:
-            f.write(jtempl.render(data))
-
-    def plot(self, dir_result):
-        self.plot_trend_coll(dir_result, True, [])
+        # A script instead of a JSON file, so that the page can load it
+        # also when it is opened as a local file.
+        with open(os.path.join(dir_result, f'{basename}.js'), 'w') as f:
+            f.write('const DATA = ')
+            json.dump(data, f, ensure_ascii=False, separators=(',', ':'))
+            f.write(';\n')
+        jtempl = _template('templates/tokens.html')
+        with open(os.path.join(dir_result, f'{basename}.html'), 'w') as f:
+            f.write(
+                jtempl.render(title=title,
+                              subtitle=subtitle,
+                              datafile=f'{basename}.js'))
+
+    def plot(self, dir_result, workers=None):
+        render_figures(self.figures(dir_result), workers)
+
+    def figures(self, dir_result):
+        return [make() for deps, make in self.figure_tasks(dir_result)]
+
+    def figure_tasks(self, dir_result):
+        """Returns a list of (deps, make): make() returns a Figure once the
+        outputs of the MultiCurves in deps have been read."""
+        p = functools.partial
+        every = self.curvelist + [self.overall]
+        tasks = []
+        tasks.append((every, p(self.figure_trend_coll, dir_result, True, [])))
         for coll in self.colls:
-            self.plot_trend_coll(dir_result, True, [coll])
-        self.plot_trend_coll(dir_result, False, self.colls)
+            tasks.append(
+                (every, p(self.figure_trend_coll, dir_result, True, [coll])))
+        tasks.append(
+            (every, p(self.figure_trend_coll, dir_result, False, self.colls)))
         for highlight in [None] + self.metadata.periods_highlight:
-            self.plot_timeseries(dir_result, highlight)
+            tasks.append(
+                (every, p(self.figure_timeseries, dir_result, highlight)))
             for coll in self.colls:
-                self.plot_timeseries_coll(dir_result, coll, highlight)
-        self.plot_overall(dir_result)
+                tasks.append((every,
+                              p(self.figure_timeseries_coll, dir_result, coll,
+                                highlight)))
+        tasks.append((every, p(self.figure_overall, dir_result)))
         for coll in self.colls:
-            self.plot_overall_coll(dir_result, coll)
+            tasks.append((every, p(self.figure_overall_coll, dir_result,
+                                   coll)))
         for curve in self.curvelist:
-            curve.plot(dir_result)
-        self.overall.plot(dir_result)
+            tasks.append(([curve], p(curve.figure, dir_result)))
+        tasks.append(([self.overall], p(self.overall.figure, dir_result)))
         for other in self.curvelist:
-            self.overall.plot(dir_result, other)
-
-    def plot_start(self):
-        fig = plt.figure(figsize=(7, 5))
-        ax = fig.add_axes([0.13, 0.14, 0.84, 0.84])
-        ax.set_ylim(self.metadata.yrange)
-        ax.set_xlabel(self.metadata.timeseries_xlabel, labelpad=15)
-        ax.set_ylabel(self.metadata.ylabel, labelpad=8)
+            tasks.append(
+                ([self.overall], p(self.overall.figure, dir_result, other)))
+        return tasks
+
+    def figure_start(self, dir_result, basename):
+        fig = Figure(dir_result, self.metadata, [0.13, 0.14, 0.84, 0.84],
+                     'percent-suffix', basename)
+        fig.ax('set_ylim', self.metadata.yrange)
+        fig.ax('set_xlabel', self.metadata.timeseries_xlabel, labelpad=15)
+        fig.ax('set_ylabel', self.metadata.ylabel, labelpad=8)
         years = [p[0] for p in self.metadata.periods]
         major_years = [c.period[0] for c in self.curvelist if c.is_major]
-        ax.set_xticks(years, minor=True)
-        ax.set_xticks(major_years, minor=False)
-        ax.set_xticklabels([c.pperiod for c in self.curvelist if c.is_major],
-                           minor=False)
-        ax.yaxis.set_major_formatter(MyPercentFormatter())
+        fig.ax('set_xticks', years, minor=True)
+        fig.ax('set_xticks', major_years, minor=False)
+        fig.ax('set_xticklabels',
+               [c.pperiod for c in self.curvelist if c.is_major],
+               minor=False)
         for y in major_years:
-            ax.axvline(y, color='#000000', linewidth=1, alpha=0.1)
-        ax.tick_params(which='major', length=6)
-        ax.tick_params(which='minor', length=2)
-        return fig, ax, years
-
-    def plot_finish(self, fig, dir_result, basename):
-        os.makedirs(dir_result, exist_ok=True)
-        if self.metadata.pdf:
-            filename = os.path.join(dir_result, f'{basename}.pdf')
-            logging.debug(filename)
-            fig.savefig(filename)
-        if self.metadata.png:
-            filename = os.path.join(dir_result, f'{basename}.png')
-            logging.debug(filename)
-            fig.savefig(filename, dpi=self.metadata.png)
-        plt.close(fig)
-
-    def plot_trend_coll(self, dir_result, show_full, colls):
+            fig.ax('axvline', y, color='#000000', linewidth=1, alpha=0.1)
+        fig.ax('tick_params', which='major', length=6)
+        fig.ax('tick_params', which='minor', length=2)
+        return fig, years
+
+    def figure_trend_coll(self, dir_result, show_full, colls):
         only_full = len(colls) == 0
 
-        fig, ax, years = self.plot_start()
+        basename = 'trend'
+        for coll in sorted(colls):
+            basename += '-' + coll
+        fig, years = self.figure_start(dir_result, basename)
 
         def maxN(l):
             return max([0 if x is None else x for x in l])
@@ -638,126 +1431,763 @@ class TimeSeries:
                 pct = [c.get_mean_pct(i) for c in self.curvelist]
                 ymax = max(ymax, maxN(pct))
                 ymin = min(ymin, minN(pct))
-                ax.plot(years,
-                        pct,
-                        color=lighter(col, i / xx),
-                        linewidth=2 if only_full else 1,
-                        markersize=6 if only_full else 2,
-                        marker='o')
+                fig.ax('plot',
+                       years,
+                       pct,
+                       color=lighter(col, i / xx),
+                       linewidth=2 if only_full else 1,
+                       markersize=6 if only_full else 2,
+                       marker='o')
 
         for coll in colls:
             for i in self.metadata.trend_step:
                 pct = [c.points[coll].get_mean_pct(i) for c in self.curvelist]
                 ymax = max(ymax, maxN(pct))
                 ymin = min(ymin, minN(pct))
-                ax.plot(years,
-                        pct,
-                        linewidth=2,
-                        markersize=6,
-                        **self.metadata.get_plot_attr(coll, i / xx))
+                fig.ax('plot',
+                       years,
+                       pct,
+                       linewidth=2,
+                       markersize=6,
+                       **self.metadata.get_plot_attr(coll, i / xx))
 
         if ymin < 0.4 * ymax:
             ymin = 0
         delta = ymax - ymin
         margin = 0.05 * delta
         if 'trend_yrange' in self.metadata.__dict__:
-            ax.set_ylim(self.metadata.trend_yrange)
+            fig.ax('set_ylim', self.metadata.trend_yrange)
         else:
-            ax.set_ylim([ymin - margin, ymax + margin])
-
-        basename = 'trend'
-        for coll in sorted(colls):
-            basename += '-' + coll
-        self.plot_finish(fig, dir_result, basename)
+            fig.ax('set_ylim', [ymin - margin, ymax + margin])
+        return fig
 
-    def plot_timeseries(self, dir_result, highlight):
-        fig, ax, years = self.plot_start()
+    def figure_timeseries(self, dir_result, highlight):
+        basename = f'timeseries'
+        if highlight:
+            basename += f'-{highlight[0]}-{highlight[1]-1}'
+        fig, years = self.figure_start(dir_result, basename)
 
         if highlight:
             c = self.curves[highlight]
-            ax.axvline(c.period[0],
-                       color='#000000',
-                       linewidth=2,
-                       ls=':',
-                       alpha=0.5)
+            fig.ax('axvline',
+                   c.period[0],
+                   color='#000000',
+                   linewidth=2,
+                   ls=':',
+                   alpha=0.5)
 
         for coll in self.colls:
             pct = [c.get_pct(coll) for c in self.curvelist]
-            ax.plot(years,
-                    pct,
-                    linewidth=2,
-                    **self.metadata.get_plot_attr(coll))
-
-        basename = f'timeseries'
+            fig.ax('plot',
+                   years,
+                   pct,
+                   linewidth=2,
+                   **self.metadata.get_plot_attr(coll))
+        return fig
+
+    def figure_timeseries_coll(self, dir_result, coll, highlight):
+        basename = f'timeseries-{coll}'
         if highlight:
             basename += f'-{highlight[0]}-{highlight[1]-1}'
-
-        self.plot_finish(fig, dir_result, basename)
-
-    def plot_timeseries_coll(self, dir_result, coll, highlight):
-        fig, ax, years = self.plot_start()
+        fig, years = self.figure_start(dir_result, basename)
 
         pct = [c.get_pct(coll) for c in self.curvelist]
         for f in self.metadata.shading_fraction:
             up = [c.get_up_pct_coll(coll, f) for c in self.curvelist]
             low = [c.get_low_pct_coll(coll, f) for c in self.curvelist]
-            ax.fill_between(years,
-                            up,
-                            low,
-                            color='#808080',
-                            alpha=0.1,
-                            linewidth=0)
+            fig.ax('fill_between',
+                   years,
+                   up,
+                   low,
+                   color='#808080',
+                   alpha=0.1,
+                   linewidth=0)
         if highlight:
             c = self.curves[highlight]
             f = min(self.metadata.shading_fraction)
             up = c.get_up_pct_coll(coll, f)
             low = c.get_low_pct_coll(coll, f)
-            ax.plot([c.period[0], c.period[0]], [up, low],
-                    color=self.metadata.coll_colors[coll],
-                    linewidth=2,
-                    ls=':')
-        ax.plot(years, pct, linewidth=2, **self.metadata.get_plot_attr(coll))
-        basename = f'timeseries-{coll}'
-        if highlight:
-            basename += f'-{highlight[0]}-{highlight[1]-1}'
-        self.plot_finish(fig, dir_result, basename)
-
-    def plot_overall(self, dir_result):
-        fig, ax, years = self.plot_start()
+            fig.ax('plot', [c.period[0], c.period[0]], [up, low],
+                   color=self.metadata.coll_colors[coll],
+                   linewidth=2,
+                   ls=':')
+        fig.ax('plot',
+               years,
+               pct,
+               linewidth=2,
+               **self.metadata.get_plot_attr(coll))
+        return fig
+
+    def figure_overall(self, dir_result):
+        fig, years = self.figure_start(dir_result, 'over-time')
         pct = [c.get_pct(None) for c in self.curvelist]
         for f in self.metadata.shading_fraction:
             up = [c.get_up_pct_overall(f) for c in self.curvelist]
             low = [c.get_low_pct_overall(f) for c in self.curvelist]
-            ax.fill_between(years,
-                            up,
-                            low,
-                            color='#000000',
-                            alpha=0.1,
-                            linewidth=0)
-        ax.plot(years, pct, color='#000000', marker='o')
-        basename = 'over-time'
-        self.plot_finish(fig, dir_result, basename)
-
-    def plot_overall_coll(self, dir_result, coll):
-        fig, ax, years = self.plot_start()
+            fig.ax('fill_between',
+                   years,
+                   up,
+                   low,
+                   color='#000000',
+                   alpha=0.1,
+                   linewidth=0)
+        fig.ax('plot', years, pct, color='#000000', marker='o')
+        return fig
+
+    def figure_overall_coll(self, dir_result, coll):
+        fig, years = self.figure_start(dir_result, f'over-time-{coll}')
         pct = [c.get_pct(coll) for c in self.curvelist]
         for f in self.metadata.shading_fraction:
             up = [c.get_up_pct_overall_coll(coll, f) for c in self.curvelist]
             low = [c.get_low_pct_overall_coll(coll, f) for c in self.curvelist]
-            ax.fill_between(years,
-                            up,
-                            low,
-                            color=self.metadata.coll_colors[coll],
-                            alpha=0.15,
-                            linewidth=0)
-        ax.plot(years, pct, **self.metadata.get_plot_attr(coll))
-        basename = f'over-time-{coll}'
-        self.plot_finish(fig, dir_result, basename)
+            fig.ax('fill_between',
+                   years,
+                   up,
+                   low,
+                   color=self.metadata.coll_colors[coll],
+                   alpha=0.15,
+                   linewidth=0)
+        fig.ax('plot', years, pct, **self.metadata.get_plot_attr(coll))
+        return fig
+
+
+class ResultIndex:
+    """SQLite index of the files in DIR_IN and DIR_OUT, keyed by digest.
+
+    For each digest, the index records the input file, the best output
+    file, its iteration count (NULL for exact results), seed, size, the
+    engine that produced it, and the time it was last used. After an
+    adaptive run, tolerance and max_iter record that the best output is
+    good enough for that tolerance up to that many iterations.
+    """
+
+    def __init__(self, filename=INDEX):
+        os.makedirs(os.path.dirname(filename), exist_ok=True)
+        is_new = not os.path.exists(filename)
+        self.db = sqlite3.connect(filename, timeout=60)
+        self.db.execute('''
+            CREATE TABLE IF NOT EXISTS results (
+                digest TEXT PRIMARY KEY,
+                input_size INTEGER,
+                output TEXT,
+                iter INTEGER,
+                seed INTEGER,
+                output_size INTEGER,
+                engine TEXT,
+                last_access REAL NOT NULL,
+                tolerance REAL,
+                max_iter INTEGER
+            )''')
+        columns = {
+            row[1]
+            for row in self.db.execute('PRAGMA table_info(results)')
+        }
+        for column, type in [('tolerance', 'REAL'), ('max_iter', 'INTEGER')]:
+            if column not in columns:
+                self.db.execute(
+                    f'ALTER TABLE results ADD COLUMN {column} {type}')
+        self.db.commit()
+        if is_new:
+            self.sync()
+
+    def close(self):
+        self.db.close()
+
+    def get(self, digest):
+        return self.db.execute(
+            'SELECT output, iter FROM results WHERE digest = ?',
+            (digest, )).fetchone()
+
+    def get_best(self, digest):
+        """Returns (q, filename) for the best output, or None."""
+        row = self.get(digest)
+        if row is None or row[0] is None:
+            return None
+        output, iter = row
+        if not os.path.exists(os.path.join(DIR_OUT, output)):
+            return None
+        return (infty if iter is None else iter), output
+
+    def has_output(self, digest, iter, tolerance=None):
+        best = self.get_best(digest)
+        if best is None:
+            return False
+        if best[0] >= iter:
+            return True
+        if tolerance is None:
+            return False
+        row = self.db.execute(
+            'SELECT tolerance, max_iter FROM results WHERE digest = ?',
+            (digest, )).fetchone()
+        return row[0] is not None and row[0] <= tolerance and row[1] >= iter
+
+    def add_input(self, digest, size):
+        self.db.execute(
+            '''INSERT INTO results (digest, input_size, last_access)
+            VALUES (?, ?, ?) ON CONFLICT (digest)
+            DO UPDATE SET input_size = excluded.input_size,
+            last_access = excluded.last_access''',
+            (digest, size, time.time()))
+
+    def add_output(self, digest, fn, engine=None):
+        """Registers DIR_OUT/fn. If it and the current best output for the
+        digest were calculated with disjoint seeds, they are merged;
+        otherwise keeps the better one and deletes the other."""
+        best = self.get_best(digest)
+        if best is not None and best[1] != fn:
+            merged = merge_outputs(digest, [best[1], fn])
+            if merged is not None:
+                fn = merged
+            elif best[0] >= _output_quality(fn):
+                os.unlink(os.path.join(DIR_OUT, fn))
+                return
+            else:
+                os.unlink(os.path.join(DIR_OUT, best[1]))
+        filename = os.path.join(DIR_OUT, fn)
+        q = _output_quality(fn)
+        # The seed column is NULL for exact and merged outputs.
+        seeds = output_seeds(filename)
+        seed = seeds[0] if len(seeds) == 1 else None
+        self.db.execute(
+            '''INSERT INTO results (digest, output, iter, seed, output_size,
+            engine, last_access) VALUES (?, ?, ?, ?, ?, ?, ?)
+            ON CONFLICT (digest) DO UPDATE SET output = excluded.output,
+            iter = excluded.iter, seed = excluded.seed,
+            output_size = excluded.output_size, engine = excluded.engine,
+            last_access = excluded.last_access''',
+            (digest, fn, None if q == infty else q, seed,
+             os.path.getsize(filename), engine, time.time()))
+
+    def add_new_outputs(self,
+                        digest,
+                        iter,
+                        engine,
+                        tolerance=None,
+                        seed=DEFAULT_SEED):
+        """Registers the output files that an engine run with iter
+        iterations may have produced for the digest. With tolerance, the
+        run was adaptive and the number of iterations is not known."""
+        candidates = [
+            fn for fn in [digest, output_name(digest, iter, seed)]
+            if os.path.exists(os.path.join(DIR_OUT, fn))
+        ]
+        if not candidates or tolerance is not None:
+            # The engine found an unindexed output that was good enough.
+            candidates = [
+                os.path.basename(fn)
+                for fn in glob.glob(os.path.join(DIR_OUT, digest + '*'))
+                if not _is_temp(fn)
+            ]
+        for fn in candidates:
+            # Registering a better output may have deleted a worse one.
+            if os.path.exists(os.path.join(DIR_OUT, fn)):
+                self.add_output(digest, fn, engine)
+        if tolerance is not None:
+            self.db.execute(
+                '''UPDATE results SET tolerance = ?, max_iter = ?
+                WHERE digest = ?''', (tolerance, iter, digest))
+
+    def touch(self, digests):
+        now = time.time()
+        self.db.executemany(
+            'UPDATE results SET last_access = ? WHERE digest = ?',
+            [(now, digest) for digest in digests])
+
+    def commit(self):
+        self.db.commit()
+
+    def sync(self):
+        """Rebuilds the index from the contents of DIR_IN and DIR_OUT.
+
+        Outputs of the same digest with disjoint seeds, e.g. copied from
+        runs on other machines, are merged."""
+        logging.info(f'{INDEX}: scanning {DIR_IN} and {DIR_OUT}')
+        known = {
+            row[0]: row[1:]
+            for row in self.db.execute(
+                '''SELECT digest, output, engine, last_access, tolerance,
+                max_iter FROM results''')
+        }
+        self.db.execute('DELETE FROM results')
+        os.makedirs(DIR_IN, exist_ok=True)
+        for fn in os.listdir(DIR_IN):
+            if _is_temp(fn):
+                continue
+            filename = os.path.join(DIR_IN, fn)
+            last_access = known[fn][2] if fn in known else os.path.getmtime(
+                filename)
+            self.db.execute(
+                '''INSERT INTO results (digest, input_size, last_access)
+                VALUES (?, ?, ?)''',
+                (fn, os.path.getsize(filename), last_access))
+        for digest, l in list_outputs().items():
+            for q, fn in sorted(l):
+                engine = None
+                if digest in known and known[digest][0] == fn:
+                    engine = known[digest][1]
+                self.add_output(digest, fn, engine)
+            if digest in known:
+                self.touch_at(digest, known[digest][2])
+                if known[digest][0] == self.get(digest)[0]:
+                    self.db.execute(
+                        '''UPDATE results SET tolerance = ?, max_iter = ?
+                        WHERE digest = ?''', (*known[digest][3:], digest))
+            else:
+                self.touch_at(
+                    digest,
+                    os.path.getmtime(
+                        os.path.join(DIR_OUT,
+                                     self.get(digest)[0])))
+        self.commit()
+
+    def touch_at(self, digest, t):
+        self.db.execute('UPDATE results SET last_access = ? WHERE digest = ?',
+                        (t, digest))
+
+    def gc(self, max_age=None, max_size=None):
+        """Deletes the inputs and outputs of digests that have not been used
+        in max_age seconds, and then the least recently used ones until the
+        total size is at most max_size bytes."""
+        self.sync()
+        rows = self.db.execute(
+            '''SELECT digest, output, COALESCE(input_size, 0),
+            COALESCE(output_size, 0), last_access
+            FROM results ORDER BY last_access''').fetchall()
+        total = sum(row[2] + row[3] for row in rows)
+        now = time.time()
+        removed = 0
+        removed_size = 0
+        for digest, output, input_size, output_size, last_access in rows:
+            too_old = max_age is not None and last_access < now - max_age
+            too_big = max_size is not None and total > max_size
+            if not too_old and not too_big:
+                break
+            if input_size:
+                os.unlink(os.path.join(DIR_IN, digest))
+            if output is not None:
+                os.unlink(os.path.join(DIR_OUT, output))
+            self.db.execute('DELETE FROM results WHERE digest = ?',
+                            (digest, ))
+            total -= input_size + output_size
+            removed += 1
+            removed_size += input_size + output_size
+        self.commit()
+        logging.info(
+            f'{INDEX}: removed {removed} digests, {removed_size} bytes; '
+            f'kept {len(rows) - removed} digests, {total} bytes')
+        return removed, removed_size
+
+
+class SubprocessEngine:
+    """Runs the compiled build/type-ratio tool over DIR_IN.
+
+    With split > 1, the iterations of each random job are divided into
+    that many independent streams that can run on different cores; the
+    results are reproducible for a fixed value of split.
+
+    With queue, the tool claims jobs through lock files in
+    type-ratio-data/queue/<queue>, so that processes on other machines
+    that share the directory can help with `build/type-ratio
+    --queue=<queue> ITER`; a job whose lock has not been refreshed for
+    lease seconds is taken over.
+
+    With threads, the tool uses at most that many threads (by default, one
+    per core).
+    """
+
+    version = 'type-ratio 1'
+
+    def __init__(self,
+                 binary=None,
+                 split=None,
+                 queue=None,
+                 lease=None,
+                 threads=None):
+        if binary is None:
+            binary = os.path.join(CODE_DIR, 'build/type-ratio')
+        self.binary = binary
+        self.split = split
+        self.queue = queue
+        self.lease = lease
+        self.threads = threads
+
+    def run(self,
+            jobs,
+            iter,
+            text=False,
+            tolerance=None,
+            levels=None,
+            seed=DEFAULT_SEED,
+            progress=None):
+        # Pass the jobs on stdin so that other inputs in DIR_IN are not
+        # recalculated.
+        args = [self.binary, '--jobs=-', str(iter)]
+        if text:
+            args.append('--text')
+        if self.split:
+            args.append(f'--split={self.split}')
+        if seed != DEFAULT_SEED:
+            args.append(f'--seed={seed}')
+        if self.queue:
+            args.append(f'--queue={self.queue}')
+            if self.lease:
+                args.append(f'--lease={self.lease}')
+            # These jobs need calculation even if an earlier run with the
+            # same queue marked them as done.
+            for digest in jobs:
+                marker = os.path.join(DIR_QUEUE, self.queue, digest + '.done')
+                if os.path.exists(marker):
+                    os.unlink(marker)
+        if tolerance is not None:
+            args.append(f'--adaptive={tolerance!r}')
+            if levels:
+                args.append('--levels=' + ','.join(map(repr, levels)))
+        logging.debug(' '.join(args))
+        env = None
+        if self.threads:
+            env = dict(os.environ, OMP_NUM_THREADS=str(self.threads))
+        if progress is None:
+            subprocess.run(args,
+                           input=''.join(d + '\n' for d in sorted(jobs)),
+                           text=True,
+                           env=env,
+                           check=True)
+            return
+        # The tool reports each job as '+ DIGEST ...' when it starts and
+        # '- DIGEST ...' when it is done. It reads all of its input before
+        # writing anything, so the pipes cannot deadlock.
+        with subprocess.Popen(args,
+                              stdin=subprocess.PIPE,
+                              stdout=subprocess.PIPE,
+                              text=True,
+                              env=env) as p:
+            p.stdin.write(''.join(d + '\n' for d in sorted(jobs)))
+            p.stdin.close()
+            for line in p.stdout:
+                sys.stdout.write(line)
+                sys.stdout.flush()
+                parts = line.split()
+                if len(parts) >= 2 and parts[0] in '+-':
+                    progress(parts[0], parts[1])
+        if p.returncode:
+            raise subprocess.CalledProcessError(p.returncode, args)
+
+
+class NumpyEngine:
+    """In-process engine that processes permutations in vectorized batches.
+
+    Produces the same output files as the C++ tool. Exact results are
+    identical up to scaling (see EXACT_UNSCALED_N); random results are
+    statistically equivalent but use a different random number generator.
+    """
+
+    version = 'numpy 1'
+
+    def __init__(self, batch_size=1 << 22):
+        # Upper bound on the number of array elements per batch.
+        self.batch_size = batch_size
+
+    def run(self,
+            jobs,
+            iter,
+            text=False,
+            tolerance=None,
+            levels=None,
+            seed=DEFAULT_SEED,
+            progress=None):
+        os.makedirs(DIR_OUT, exist_ok=True)
+        for digest, curve in sorted(jobs.items()):
+            if progress:
+                progress('+', digest)
+            self.run_job(digest, curve, iter, text, tolerance, levels, seed)
+            if progress:
+                progress('-', digest)
+
+    def run_job(self,
+                digest,
+                curve,
+                iter,
+                text,
+                tolerance=None,
+                levels=None,
+                seed=DEFAULT_SEED):
+        n = len(curve.data)
+        m0, m1 = curve.dim
+        logging.debug(f'+ {digest}  {n} {m0}+{m1}')
+        limit = EXACT_PREFERENCE * iter
+        small = _count_orders(_sample_classes(curve.data), limit) <= limit
+        accum, done = self.calc(curve.data, m0, m1, iter, small, tolerance,
+                                levels or COMPARISON_LEVELS, seed)
+        fn = output_name(digest, None if small else done, seed)
+        write_output(os.path.join(DIR_OUT, fn),
+                     accum,
+                     0 if small else done,
+                     0 if small else seed,
+                     text=text)
+        logging.debug(f'- {digest}  {n} {m0}+{m1}')
+
+    def calc(self,
+             data,
+             m0,
+             m1,
+             iter,
+             small,
+             tolerance=None,
+             levels=None,
+             seed=DEFAULT_SEED):
+        """Returns the accumulator and the number of iterations done; with
+        tolerance, random permutations are processed in rounds as in the
+        C++ tool until the quantiles at the given levels converge."""
+        n = len(data)
+        mm = m0 + m1
+        accum = np.zeros((mm + 1) * (m0 + 1), dtype=np.int64)
+        if n == 0:
+            return accum.reshape(mm + 1, m0 + 1), iter
+        # Incidence lists sorted by type: for each type, the samples it
+        # occurs in; types 0..m0-1 are from dataset 0.
+        types = []
+        samples = []
+        for i, row in enumerate(data):
+            types.extend(row[0])
+            types.extend(t + m0 for t in row[1])
+            samples.extend([i] * (len(row[0]) + len(row[1])))
+        types = np.array(types, dtype=np.int64)
+        samples = np.array(samples, dtype=np.int64)
+        order = np.argsort(types, kind='stable')
+        types = types[order]
+        samples = samples[order]
+        present, starts = np.unique(types, return_index=True)
+        is0 = present < m0
+        k = max(1, self.batch_size // max(n, len(samples)))
+        if small:
+            classes = _sample_classes(data)
+            perms = _distinct_orders(classes)
+            while True:
+                batch = np.array(list(itertools.islice(perms, k)),
+                                 dtype=np.int64)
+                if len(batch) == 0:
+                    break
+                self.process(accum, batch, samples, starts, is0, m0)
+            if n <= EXACT_UNSCALED_N:
+                # Each distinct order stands for this many permutations.
+                accum *= math.prod(math.factorial(len(c)) for c in classes)
+            return accum.reshape(mm + 1, m0 + 1), iter
+        rng = np.random.default_rng(seed)
+        base = np.arange(n, dtype=np.int64)
+        done = 0
+        size = iter if tolerance is None else min(iter, ADAPTIVE_FIRST_ROUND)
+        prev = None
+        while True:
+            for it in range(0, size, k):
+                kk = min(k, size - it)
+                batch = rng.permuted(np.tile(base, (kk, 1)), axis=1)
+                self.process(accum, batch, samples, starts, is0, m0)
+            done += size
+            if tolerance is None or done >= iter:
+                break
+            q = _adaptive_quantiles(accum.reshape(mm + 1, m0 + 1), levels)
+            converged = (prev is not None
+                         and done * min(levels) >= ADAPTIVE_MIN_TAIL
+                         and _adaptive_converged(prev, q, tolerance))
+            prev = q
+            if converged:
+                break
+            size = min(done, iter - done)
+        return accum.reshape(mm + 1, m0 + 1), done
+
+    @staticmethod
+    def process(accum, perms, samples, starts, is0, m0):
+        k, n = perms.shape
+        rank = np.empty_like(perms)
+        rank[np.arange(k)[:, None], perms] = np.arange(n)
+        offset = (np.arange(k) * n)[:, None]
+        if len(samples) == 0:
+            x = np.zeros((k, n), dtype=np.int64)
+            y = x
+        else:
+            # Position at which each type is seen for the first time.
+            first = np.minimum.reduceat(rank[:, samples], starts, axis=1)
+            x = np.bincount((first + offset).ravel(), minlength=k * n)
+            y = np.bincount((first[:, is0] + offset).ravel(),
+                            minlength=k * n)
+            x = x.reshape(k, n).cumsum(axis=1)
+            y = y.reshape(k, n).cumsum(axis=1)
+        cells = np.bincount((x * (m0 + 1) + y).ravel(), minlength=len(accum))
+        accum += cells
+
+
+def _sample_classes(data):
+    """Groups the indices of samples with identical types."""
+    classes = {}
+    for i, row in enumerate(data):
+        key = (frozenset(row[0]), frozenset(row[1]))
+        classes.setdefault(key, []).append(i)
+    return list(classes.values())
+
+
+def _count_orders(classes, limit):
+    """The number of distinct orders of samples, n! divided by the
+    factorials of the class sizes, or limit + 1 if it is larger."""
+    count = 1
+    total = 0
+    for c in classes:
+        total += len(c)
+        count *= math.comb(total, len(c))
+        if count > limit:
+            return limit + 1
+    return count
+
+
+def _distinct_orders(classes):
+    """Yields one permutation of the samples for each distinct order of
+    the classes, in which the samples of each class appear in order."""
+    labels = sorted(j for j, c in enumerate(classes) for i in c)
+    n = len(labels)
+    while True:
+        pos = [0] * len(classes)
+        perm = []
+        for j in labels:
+            perm.append(classes[j][pos[j]])
+            pos[j] += 1
+        yield perm
+        # Next permutation of labels in lexicographic order.
+        i = n - 2
+        while i >= 0 and labels[i] >= labels[i + 1]:
+            i -= 1
+        if i < 0:
+            return
+        j = n - 1
+        while labels[j] <= labels[i]:
+            j -= 1
+        labels[i], labels[j] = labels[j], labels[i]
+        labels[i + 1:] = reversed(labels[i + 1:])
+
+
+def _adaptive_quantiles(accum, levels):
+    """For each x and level, the lower and upper quantiles of y as in
+    Curve.quantiles, or -2 if the row has too few permutations to resolve
+    the tails at this level; shape (rows, 2 * len(levels))."""
+    cum = accum.cumsum(axis=1)
+    tot = cum[:, -1:]
+    q = []
+    for level in levels:
+        resolved = tot[:, 0] * level >= ADAPTIVE_MIN_TAIL
+        low = (cum <= tot * level).sum(axis=1)
+        up = (cum[:, :-1] < tot * (1.0 - level)).sum(axis=1)
+        q.append(np.where(resolved, low, -2))
+        q.append(np.where(resolved, up, -2))
+    return np.stack(q, axis=1)
+
+
+def _adaptive_converged(prev, q, tolerance):
+    """True if no resolved quantile of y/x moved by more than tolerance."""
+    x = np.arange(len(q))[:, None]
+    ok = (q == -2) | (prev == -2) | (np.abs(q - prev) <= tolerance * x)
+    return bool(ok.all())
+
+
+def _seconds(t):
+    # Rounding errors can make differences of CPU times slightly negative.
+    return round(max(t, 0.0), 6)
+
+
+def _cpu_time(who):
+    usage = resource.getrusage(who)
+    return usage.ru_utime + usage.ru_stime
+
+
+def _max_rss(who):
+    """Peak resident set size in bytes."""
+    rss = resource.getrusage(who).ru_maxrss
+    # Kilobytes on Linux, bytes on macOS.
+    return rss if sys.platform == 'darwin' else rss * 1024
+
+
+class Timings:
+    """Collects the wall-clock time, CPU time and peak memory use of each
+    stage of a calculation, and the size and running time of each job.
+
+    If hook is given, it is called as hook('stage', record) after each stage
+    and hook('job', record) after each job that the engine finishes, e.g.
+    to feed an external metrics collector."""
+
+    def __init__(self, hook=None):
+        self.hook = hook
+        self.stages = []
+        self.jobs = {}
+        self._started = {}
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        wall = time.perf_counter()
+        cpu = _cpu_time(resource.RUSAGE_SELF)
+        cpu_children = _cpu_time(resource.RUSAGE_CHILDREN)
+        yield
+        wall = time.perf_counter() - wall
+        cpu = _cpu_time(resource.RUSAGE_SELF) - cpu
+        cpu_children = _cpu_time(resource.RUSAGE_CHILDREN) - cpu_children
+        record = {
+            'stage': name,
+            'wall': _seconds(wall),
+            'cpu': _seconds(cpu),
+            'cpu_children': _seconds(cpu_children),
+            'max_rss': _max_rss(resource.RUSAGE_SELF),
+            'max_rss_children': _max_rss(resource.RUSAGE_CHILDREN),
+        }
+        logging.debug(f'{name}: {wall:.3f} s')
+        self.stages.append(record)
+        if self.hook:
+            self.hook('stage', record)
+
+    def add_job(self, digest, curve, cached):
+        m0, m1 = curve.dim
+        self.jobs[digest] = {
+            'digest': digest,
+            'n': len(curve.data),
+            'm0': m0,
+            'm1': m1,
+            'cached': cached,
+            'wall': None if cached else 0.0,
+        }
+
+    def progress(self, event, digest):
+        """Engine progress callback: event is '+' when the job starts and
+        '-' when it is done."""
+        if event == '+':
+            self._started[digest] = time.perf_counter()
+            return
+        record = self.jobs.get(digest)
+        start = self._started.pop(digest, None)
+        if record is None or start is None:
+            return
+        wall = time.perf_counter() - start
+        record['wall'] = _seconds(record['wall'] + wall)
+        if self.hook:
+            self.hook('job', record)
+
+    def write(self, filename, **info):
+        with open(filename, 'w') as f:
+            json.dump(dict(info,
+                           stages=self.stages,
+                           jobs=sorted(self.jobs.values(),
+                                       key=lambda r: r['digest'])),
+                      f,
+                      indent=1)
+            f.write('\n')
 
 
 class Driver:
 
-    def __init__(self, label=None, dir_result=None):
+    def __init__(self,
+                 label=None,
+                 dir_result=None,
+                 engine=None,
+                 text=False,
+                 workers=None,
+                 metrics=None,
+                 pipeline=False,
+                 freq_top=(5, ),
+                 render=True):
         self.timeseries = []
         self.curves = []
         if dir_result is not None:
@@ -765,63 +2195,658 @@ class Driver:
         else:
             assert label is not None
             self.dir_result = DIR_RESULT + '-' + label
+        self.engine = engine if engine is not None else SubprocessEngine()
+        # Use the text file format for engine inputs and outputs.
+        self.text = text
+        # Number of processes for rendering figures.
+        self.workers = workers
+        # Called as metrics(kind, record) for each stage and job, see
+        # Timings.
+        self.metrics = metrics
+        # Read outputs and render figures while the engine is running.
+        self.pipeline = pipeline
+        # Write the top k types to freq-k.txt for each k in freq_top, in
+        # addition to the full listing in freq.txt.
+        self.freq_top = freq_top
+        # Render figures and HTML files; with render=False, only the
+        # calculation, summary.txt and the frequency reports are done.
+        self.render = render
 
     def add_timeseries(self, ts):
         self.timeseries.append(ts)
         self.curves.extend(ts.curvelist)
         self.curves.append(ts.overall)
 
-    def calc(self, iter):
-        logging.info(f'{self.dir_result}: calculation')
+    def levels(self):
+        """Quantile levels that adaptive runs check for convergence."""
+        levels = set(COMPARISON_LEVELS)
         for curve in self.curves:
-            curve.calc_write_input_all()
-        args = [os.path.join(CODE_DIR, 'build/type-ratio'), str(iter)]
-        logging.debug(' '.join(args))
-        subprocess.run(args, check=True)
+            levels.update(curve.metadata.shading_fraction)
+        return sorted(levels, reverse=True)
+
+    def calc(self, iter, tolerance=None, top_up=False, stage=None):
+        """Calculates all curves with iter iterations. With tolerance, the
+        engine stops early once the quantiles of y/x at self.levels() change
+        by at most tolerance between rounds; iter is then an upper bound.
+
+        With top_up, random results with fewer than iter iterations are
+        extended with the missing iterations, calculated with a new seed,
+        instead of being recalculated from scratch. Runs with tolerance
+        always start from scratch, so top_up cannot be combined with
+        tolerance (ValueError).
+
+        With stage, only a part of the calculation is done, so that the
+        parts can be run separately, e.g. on different machines that share
+        type-ratio-data: 'prepare' only writes the inputs, 'compute' also
+        runs the engine, and 'report' reads the outputs and writes the
+        results (all outputs must exist already).
+
+        The time and memory use of each stage and the size and running
+        time of each job are written to timings.json in the result
+        directory (see Timings)."""
+        assert stage in STAGES, stage
+        self.check_top_up(tolerance, top_up)
+        timings = Timings(self.metrics)
+        index = ResultIndex()
+        jobs, todo = self.prepare(index, iter, tolerance, timings,
+                                  stage == 'report')
+        if stage == 'prepare':
+            index.close()
+            return
+        runs = self.engine_runs(index, todo, iter, tolerance, top_up)
+        if self.pipeline and stage != 'compute':
+            self.calc_pipeline(index, jobs, runs, tolerance, timings)
+        else:
+            with timings.stage('engine'):
+                for n, seed, jobs_n in runs:
+                    self.run_engine(jobs_n, n, tolerance, seed,
+                                    timings.progress)
+                    for digest in jobs_n:
+                        index.add_new_outputs(digest, n, self.engine.version,
+                                              tolerance, seed)
+                index.commit()
+            if stage == 'compute':
+                index.close()
+                logging.info(f'{self.dir_result}: computed')
+                return
+            self.report(index, jobs, timings)
+        self.write_timings(timings, iter, tolerance, self.engine)
+
+    def prepare(self, index, iter, tolerance, timings, require_outputs=False):
+        """The input stage of calc: computes the inputs of all curves and
+        writes the inputs of the jobs that need calculation. Returns the
+        jobs and the jobs that need calculation, as dicts from digests to
+        curves. With require_outputs, closes the index and raises
+        RuntimeError if some jobs need calculation."""
+        logging.info(f'{self.dir_result}: calculation')
+        with timings.stage('input'):
+            jobs, todo = self.input_jobs(index, iter, tolerance)
+            if require_outputs and todo:
+                index.close()
+                raise RuntimeError(
+                    f'{self.dir_result}: {len(todo)} of {len(jobs)} jobs '
+                    f'have no results')
+            for digest, c in jobs.items():
+                timings.add_job(digest, c, digest not in todo)
+            for digest, c in todo.items():
+                c.write_input()
+                index.add_input(digest, c.input_size)
+            index.commit()
+            for curve in self.curves:
+                for c in curve.get_curves():
+                    c.input_data = None
+        logging.info(f'{self.dir_result}: {len(todo)} of {len(jobs)} jobs '
+                     f'need calculation')
+        return jobs, todo
+
+    def report(self, index, jobs, timings):
+        """The stages of calc after the engine: reads the outputs of the
+        jobs and writes the results. Closes the index."""
         logging.info(f'{self.dir_result}: read result')
+        with timings.stage('read_output'):
+            self.clean()
+            self.find_best(index, jobs)
+            index.close()
+            for curve in self.curves:
+                for c in curve.get_curves():
+                    if c is jobs[c.digest]:
+                        c.calc_read_output(self.best)
+                    else:
+                        c.share_output(jobs[c.digest])
+        logging.info(f'{self.dir_result}: process result')
+        with timings.stage('summary'):
+            self.write_summary()
+        if self.render:
+            with timings.stage('plots'):
+                figures = []
+                for ts in self.timeseries:
+                    figures.extend(ts.figures(self.dir_result))
+                render_figures(figures, self.workers)
+        with timings.stage('freq'):
+            self.write_freq()
+        if self.render:
+            with timings.stage('html'):
+                self.write_html()
+
+    def write_timings(self, timings, iter, tolerance, engine):
+        timings.write(os.path.join(self.dir_result, 'timings.json'),
+                      iter=iter,
+                      tolerance=tolerance,
+                      engine=engine.version)
+        logging.info(f'{self.dir_result}: done')
+
+    def input_jobs(self, index, iter, tolerance):
+        """Computes the inputs of all curves; returns the jobs and the jobs
+        that need calculation, as dicts from digests to curves."""
+        # Identical curves (e.g. a collection that covers a whole period)
+        # share one job.
+        jobs = {}
+        for curve in self.curves:
+            for c in curve.get_curves():
+                c.calc_input(self.text)
+                jobs.setdefault(c.digest, c)
+        todo = {
+            d: c
+            for d, c in jobs.items()
+            if not index.has_output(d, iter, tolerance)
+        }
+        return jobs, todo
+
+    def estimate(self, iter, tolerance=None, top_up=False):
+        """Estimates the work that calc would do without writing anything.
+        Returns a dict with the number of jobs, the number of jobs with
+        cached results, and a list of engine runs; the work of a run is
+        the number of sample visits, i.e. the number of iterations (or
+        distinct orders, if fewer) times the number of samples, summed
+        over its jobs. With tolerance, it is an upper bound."""
+        self.check_top_up(tolerance, top_up)
+        index = ResultIndex()
+        jobs, todo = self.input_jobs(index, iter, tolerance)
+        runs = []
+        for n, seed, jobs_n in self.engine_runs(index, todo, iter, tolerance,
+                                                top_up):
+            work = 0
+            for digest in jobs_n:
+                data = jobs[digest].data
+                limit = EXACT_PREFERENCE * n
+                orders = _count_orders(_sample_classes(data), limit)
+                work += (orders if orders <= limit else n) * len(data)
+            runs.append({
+                'iter': n,
+                'seed': seed,
+                'jobs': len(jobs_n),
+                'work': work,
+            })
+        index.close()
+        for curve in self.curves:
+            for c in curve.get_curves():
+                c.input_data = None
+        return {
+            'label': self.dir_result,
+            'jobs': len(jobs),
+            'cached': len(jobs) - len(todo),
+            'runs': runs,
+        }
+
+    def calc_pipeline(self, index, jobs, runs, tolerance, timings):
+        """Runs the engine in a background thread, reads each output as
+        soon as the engine reports that it is done, and renders each figure
+        as soon as the outputs it needs have been read. The frequency
+        reports do not need any outputs and are written while the engine
+        is running."""
         self.clean()
-        self.find_best()
+        users = collections.defaultdict(list)
         for curve in self.curves:
-            curve.calc_read_output_all(self.best)
-        logging.info(f'{self.dir_result}: process result')
+            for c in curve.get_curves():
+                users[c.digest].append(c)
+        tasks = []
+        if self.render:
+            for ts in self.timeseries:
+                tasks.extend(ts.figure_tasks(self.dir_result))
+        pending = set()
+        for n, seed, jobs_n in runs:
+            pending.update(jobs_n)
+        ready = set()
+        events = queue.Queue()
+
+        def run():
+            try:
+                for n, seed, jobs_n in runs:
+
+                    def progress(event, digest):
+                        timings.progress(event, digest)
+                        if event == '-':
+                            events.put((digest, n, seed))
+
+                    self.run_engine(jobs_n, n, tolerance, seed, progress)
+                    # Jobs that were not reported, e.g. because another
+                    # process in the same queue calculated them.
+                    for digest in jobs_n:
+                        events.put((digest, n, seed))
+            except BaseException as e:
+                events.put(e)
+            events.put(None)
+
+        def read(digest):
+            best = index.get_best(digest)
+            assert best is not None, digest
+            self.best[digest] = best[1]
+            c = jobs[digest]
+            c.calc_read_output(self.best)
+            for other in users[digest]:
+                if other is not c:
+                    other.share_output(c)
+            ready.add(digest)
+
+        pool = None
+        if self.render and self.workers is not None and self.workers > 1:
+            pool = concurrent.futures.ProcessPoolExecutor(self.workers)
+            # Start the worker processes before the engine thread.
+            pool.submit(int).result()
+        futures = []
+
+        def render_ready():
+            waiting = []
+            for deps, make in tasks:
+                if all(c.digest in ready for curve in deps
+                       for c in curve.get_curves()):
+                    figure = make()
+                    if pool is None:
+                        render_figure(figure)
+                    else:
+                        futures.append(pool.submit(render_figure, figure))
+                else:
+                    waiting.append((deps, make))
+            tasks[:] = waiting
+
+        try:
+            with timings.stage('pipeline'):
+                self.best = {}
+                for digest in jobs:
+                    if digest not in pending:
+                        read(digest)
+                render_ready()
+                thread = threading.Thread(target=run, daemon=True)
+                thread.start()
+                with timings.stage('freq'):
+                    self.write_freq()
+                if self.render:
+                    with timings.stage('html'):
+                        self.write_html()
+                while True:
+                    item = events.get()
+                    if item is None:
+                        break
+                    if isinstance(item, BaseException):
+                        raise item
+                    digest, n, seed = item
+                    if digest in ready:
+                        continue
+                    index.add_new_outputs(digest, n, self.engine.version,
+                                          tolerance, seed)
+                    read(digest)
+                    render_ready()
+                thread.join()
+                assert not tasks
+                index.commit()
+                self.find_best(index, jobs)
+                index.close()
+                with timings.stage('summary'):
+                    self.write_summary()
+                for future in futures:
+                    future.result()
+        finally:
+            if pool is not None:
+                pool.shutdown()
+
+    @staticmethod
+    def check_top_up(tolerance, top_up):
+        if top_up and tolerance is not None:
+            raise ValueError('top_up cannot be combined with tolerance')
+
+    @staticmethod
+    def engine_runs(index, todo, iter, tolerance, top_up):
+        """Returns the engine runs needed to calculate the jobs in todo as
+        a list of (iterations, seed, jobs)."""
+        if not todo:
+            return []
+        if tolerance is not None:
+            return [(iter, DEFAULT_SEED, todo)]
+        return Driver.top_up_groups(index, todo, iter, top_up)
+
+    def run_engine(self, jobs, iter, tolerance, seed, progress):
+        levels = self.levels() if tolerance is not None else None
+        self.engine.run(jobs,
+                        iter,
+                        self.text,
+                        tolerance=tolerance,
+                        levels=levels,
+                        seed=seed,
+                        progress=progress)
+
+    def write_summary(self):
         summaryfile = os.path.join(self.dir_result, 'summary.txt')
         with open(summaryfile, 'w') as f:
             for ts in self.timeseries:
                 ts.print_summary(f)
-        for ts in self.timeseries:
-            ts.plot(self.dir_result)
-        freqfile = os.path.join(self.dir_result, 'freq.txt')
-        with open(freqfile, 'w') as f:
-            for ts in self.timeseries:
-                ts.print_freq(f, None)
-        freqfile = os.path.join(self.dir_result, 'freq-5.txt')
-        with open(freqfile, 'w') as f:
+
+    def write_freq(self):
+        with contextlib.ExitStack() as stack:
+            files = {}
+            for top in [None] + sorted(self.freq_top):
+                name = 'freq.txt' if top is None else f'freq-{top}.txt'
+                files[top] = stack.enter_context(
+                    open(os.path.join(self.dir_result, name),
+                         'w',
+                         buffering=FREQ_BUFFER))
             for ts in self.timeseries:
-                ts.print_freq(f, 5)
+                ts.print_freqs(files)
+
+    def write_html(self):
         for ts in self.timeseries:
             ts.illustrate_freq(self.dir_result)
-        logging.info(f'{self.dir_result}: done')
+
+    @staticmethod
+    def top_up_groups(index, todo, iter, top_up):
+        """Splits the jobs into groups that need the same number of
+        iterations; returns a list of (iterations, seed, jobs)."""
+        groups = collections.defaultdict(dict)
+        used = set()
+        for digest, c in todo.items():
+            best = index.get_best(digest) if top_up else None
+            if best is not None:
+                filename = os.path.join(DIR_OUT, best[1])
+                # Only binary outputs record their seeds.
+                if read_output_header(filename) is not None:
+                    used.update(output_seeds(filename))
+                    groups[iter - best[0]][digest] = c
+                    continue
+            groups[iter][digest] = c
+        seed = max(used) + 1 if used else DEFAULT_SEED
+        return [(n, DEFAULT_SEED if n == iter else seed, jobs)
+                for n, jobs in sorted(groups.items(), reverse=True)]
 
     def clean(self):
         os.makedirs(self.dir_result, exist_ok=True)
         for fn in os.listdir(self.dir_result):
             os.unlink(os.path.join(self.dir_result, fn))
 
-    def find_best(self):
-        by_digest = collections.defaultdict(list)
-        for fn in os.listdir(DIR_OUT):
-            m = re.fullmatch(r'([0-9a-f]{64})((?:\.[0-9]+)?)', fn)
-            assert m is not None, fn
-            digest = m.group(1)
-            suffix = m.group(2)
-            if len(suffix) == 0:
-                q = infty
-            else:
-                q = int(suffix[1:])
-            by_digest[digest].append((q, fn))
+    def find_best(self, index, digests):
         self.best = {}
-        for digest in by_digest.keys():
-            l = sorted(by_digest[digest], reverse=True)
-            self.best[digest] = l[0][1]
-            for q, fn in l[1:]:
-                os.unlink(os.path.join(DIR_OUT, fn))
+        for digest in digests:
+            best = index.get_best(digest)
+            assert best is not None, digest
+            self.best[digest] = best[1]
+        index.touch(digests)
+        index.commit()
+
+
+class Session:
+    """Calculates the curves of several Drivers together.
+
+    Driver.calc runs the engine separately for each Driver, and the cores
+    may be idle while the largest jobs of one Driver finish. Session.calc
+    prepares the inputs of all Drivers, runs the engine once for all jobs
+    that need calculation (once for each group of iterations, see
+    Driver.calc), and then each Driver reads its results and writes its
+    reports. Jobs shared by several Drivers are calculated once. The
+    engine of the Session is used instead of those of the Drivers.
+    """
+
+    def __init__(self, engine=None, text=False):
+        self.engine = engine if engine is not None else SubprocessEngine()
+        # Use the text file format for engine outputs.
+        self.text = text
+        self.drivers = []
+
+    def add_driver(self, driver):
+        self.drivers.append(driver)
+
+    def levels(self):
+        """Quantile levels that adaptive runs check for convergence."""
+        levels = set()
+        for driver in self.drivers:
+            levels.update(driver.levels())
+        return sorted(levels, reverse=True)
+
+    def calc(self, iter, tolerance=None, top_up=False):
+        """Calculates all curves of all Drivers; the arguments are the same
+        as in Driver.calc. Each Driver writes its own timings.json, in
+        which the engine stage covers the jobs of all Drivers."""
+        Driver.check_top_up(tolerance, top_up)
+        timings = [Timings(driver.metrics) for driver in self.drivers]
+        index = ResultIndex()
+        prepared = []
+        todo = {}
+        for driver, t in zip(self.drivers, timings):
+            jobs, todo_d = driver.prepare(index, iter, tolerance, t)
+            prepared.append(jobs)
+            for digest, c in todo_d.items():
+                todo.setdefault(digest, c)
+        logging.info(f'session: {len(todo)} jobs need calculation')
+        runs = Driver.engine_runs(index, todo, iter, tolerance, top_up)
+        levels = self.levels() if tolerance is not None else None
+
+        def progress(event, digest):
+            for t in timings:
+                t.progress(event, digest)
+
+        with contextlib.ExitStack() as stack:
+            for t in timings:
+                stack.enter_context(t.stage('engine'))
+            for n, seed, jobs_n in runs:
+                self.engine.run(jobs_n,
+                                n,
+                                self.text,
+                                tolerance=tolerance,
+                                levels=levels,
+                                seed=seed,
+                                progress=progress)
+                for digest in jobs_n:
+                    index.add_new_outputs(digest, n, self.engine.version,
+                                          tolerance, seed)
+            index.commit()
+        index.close()
+        for driver, jobs, t in zip(self.drivers, prepared, timings):
+            driver.report(ResultIndex(), jobs, t)
+            driver.write_timings(t, iter, tolerance, self.engine)
+
+
+def _output_quality(fn):
+    parts = fn.split('.')
+    return int(parts[1]) if len(parts) > 1 else infty
+
+
+def _parse_size(s):
+    units = {'K': 1 << 10, 'M': 1 << 20, 'G': 1 << 30, 'T': 1 << 40}
+    if s[-1:].upper() in units:
+        return int(float(s[:-1]) * units[s[-1].upper()])
+    return int(s)
+
+
+def load_spec(filename):
+    """Reads a run specification from a TOML file (see README.md). File
+    names in the spec are relative to the directory of the spec file."""
+    try:
+        import tomllib
+    except ImportError:
+        import tomli as tomllib
+    with open(filename, 'rb') as f:
+        spec = tomllib.load(f)
+    sections = dict(SPEC_SECTIONS)
+    for coll in spec.get('collections', {}):
+        sections[f'collections.{coll}'] = SPEC_COLLECTION
+    unknown = set(spec) - set(sections) - {'collections'}
+    if unknown:
+        raise ValueError(f'{filename}: unknown sections: {sorted(unknown)}')
+    spec.setdefault('collections', {})
+    for section, keys in sections.items():
+        table = spec
+        for part in section.split('.'):
+            table = table.setdefault(part, {})
+        unknown = set(table) - set(keys)
+        if unknown:
+            raise ValueError(
+                f'{filename}: unknown keys in [{section}]: {sorted(unknown)}')
+    corpus = spec['corpus']
+    if 'file' not in corpus:
+        raise ValueError(f'{filename}: [corpus] file is missing')
+    if 'label' not in spec['output'] and 'dir' not in spec['output']:
+        raise ValueError(f'{filename}: [output] label or dir is missing')
+    base = os.path.dirname(filename)
+    for key in ['file', 'types']:
+        if key in corpus:
+            corpus[key] = os.path.join(base, corpus[key])
+    return spec
+
+
+def spec_metadata(spec, samplelist):
+    """Builds the Metadata of a run specification. Periods and collections
+    default to all periods and collections of the samples."""
+    labels = spec['labels']
+    style = spec['style']
+    output = spec['output']
+    metadata = Metadata()
+    metadata.datasets = labels.get('datasets', ['0', '1'])
+    metadata.dataset_labels = labels.get('dataset_labels', metadata.datasets)
+    metadata.title = labels.get('title', output.get('label', ''))
+    metadata.xlabel = labels.get(
+        'xlabel', ' and '.join(metadata.dataset_labels) + ' types')
+    metadata.ylabel = labels.get(
+        'ylabel', f'Proportion of {metadata.dataset_labels[0]} types')
+    metadata.timeseries_xlabel = labels.get('timeseries_xlabel', 'Time period')
+    periods = spec['periods']
+    if 'list' in periods:
+        metadata.periods = [tuple(p) for p in periods['list']]
+    else:
+        metadata.periods = list_periods(samplelist)
+    metadata.periods_highlight = [
+        tuple(p) for p in periods.get('highlight', [])
+    ]
+    tick_step = periods.get('tick_step')
+    if tick_step is None:
+        metadata.tick_hook = lambda period: True
+    else:
+        metadata.tick_hook = lambda period: period[0] % tick_step == 0
+    colls = spec['collections'] or {c: {} for c in list_colls(samplelist)}
+    metadata.coll_labels = {}
+    metadata.coll_colors = {}
+    metadata.coll_marker_open = set()
+    for i, (coll, attr) in enumerate(colls.items()):
+        metadata.coll_labels[coll] = attr.get('label', coll)
+        metadata.coll_colors[coll] = attr.get('color', f'C{i}')
+        if attr.get('marker_open', False):
+            metadata.coll_marker_open.add(coll)
+    metadata.shading_fraction = style.get('shading_fraction', [0.1, 0.025])
+    metadata.yrange = style.get('yrange', [0, 100])
+    if 'trend_yrange' in style:
+        metadata.trend_yrange = style['trend_yrange']
+    metadata.trend_step = style.get('trend_step', [100])
+    metadata.pdf = output.get('pdf', True)
+    metadata.png = output.get('png')
+    return metadata, list(colls)
+
+
+def run_spec(filename, jobs=None, engine=None, stage=None, dry_run=False):
+    """Runs the calculation described by a run specification (see
+    load_spec). jobs and engine override the number of threads and
+    processes and the engine of the spec; stage is passed to Driver.calc.
+    With dry_run, nothing is calculated; returns the estimate of
+    Driver.estimate instead."""
+    spec = load_spec(filename)
+    corpus = spec['corpus']
+    run = spec['run']
+    output = spec['output']
+    if 'types' in corpus:
+        set_vocabulary(TypeDict(corpus['types']))
+    labels = spec['labels']
+    samplelist = read_samples(corpus['file'],
+                              format=corpus.get('format'),
+                              datasets=labels.get('datasets'))
+    metadata, colls = spec_metadata(spec, samplelist)
+    engine = engine or run.get('engine', 'subprocess')
+    workers = jobs or run.get('workers')
+    if engine == 'numpy':
+        engine = NumpyEngine()
+    elif engine == 'subprocess':
+        engine = SubprocessEngine(split=run.get('split'),
+                                  queue=run.get('queue'),
+                                  threads=jobs)
+    else:
+        raise ValueError(f'{filename}: unknown engine: {engine}')
+    driver = Driver(output.get('label'),
+                    dir_result=output.get('dir'),
+                    engine=engine,
+                    workers=workers,
+                    pipeline=run.get('pipeline', False),
+                    freq_top=output.get('freq_top', (5, )),
+                    render=output.get('render', True))
+    driver.add_timeseries(TimeSeries(metadata, colls, samplelist))
+    iter = run.get('iter', 10000)
+    tolerance = run.get('tolerance')
+    top_up = run.get('top_up', False)
+    if dry_run:
+        return driver.estimate(iter, tolerance, top_up)
+    driver.calc(iter, tolerance, top_up, stage)
+
+
+def main(argv=None):
+    logging.basicConfig(format='%(levelname)s %(message)s',
+                        level=logging.INFO)
+    parser = argparse.ArgumentParser()
+    sub = parser.add_subparsers(dest='command', required=True)
+    p = sub.add_parser('run',
+                       help='run the calculation described by a TOML file')
+    p.add_argument('spec', help='run specification (TOML)')
+    p.add_argument('--jobs',
+                   type=int,
+                   metavar='N',
+                   help='number of engine threads and rendering processes')
+    p.add_argument('--engine',
+                   choices=['subprocess', 'numpy'],
+                   help='override the engine of the specification')
+    p.add_argument('--stage',
+                   choices=STAGES[1:],
+                   help='only run this stage: prepare writes the inputs, '
+                   'compute also runs the engine, report writes the results '
+                   'from existing outputs (default: all stages)')
+    p.add_argument('--dry-run',
+                   action='store_true',
+                   help='print the number of jobs that need calculation and '
+                   'an estimate of the work without calculating anything')
+    p = sub.add_parser('gc',
+                       help=f'remove old results from {DIR_IN} and {DIR_OUT}')
+    p.add_argument('--max-age',
+                   type=float,
+                   metavar='DAYS',
+                   help='remove results not used in this many days')
+    p.add_argument('--max-size',
+                   type=_parse_size,
+                   metavar='BYTES',
+                   help='remove least recently used results until the total '
+                   'size is at most this (suffixes K, M, G, T)')
+    sub.add_parser('merge',
+                   help=f'merge outputs with disjoint seeds in {DIR_OUT}')
+    args = parser.parse_args(argv)
+    if args.command == 'run':
+        estimate = run_spec(args.spec, args.jobs, args.engine, args.stage,
+                            args.dry_run)
+        if estimate is not None:
+            print(f'{estimate["label"]}: {estimate["jobs"]} jobs, '
+                  f'{estimate["cached"]} with cached results')
+            for r in estimate['runs']:
+                print(f'  {r["iter"]} iterations (seed {r["seed"]}): '
+                      f'{r["jobs"]} jobs, {r["work"]:.3g} sample visits')
+    elif args.command == 'merge':
+        index = ResultIndex()
+        index.sync()
+        index.close()
+    elif args.command == 'gc':
+        max_age = args.max_age * 86400 if args.max_age is not None else None
+        index = ResultIndex()
+        index.gc(max_age, args.max_size)
+        index.close()
+
+
+if __name__ == '__main__':
+    main()